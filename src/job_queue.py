@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A queue of search jobs kept in a directory, so that search workers
+# on any number of machines sharing a filesystem can pull from it.
+# Each job is a file that moves from pending/ to claimed/ to done/;
+# renames are atomic, so only one worker can claim or complete a
+# job. A claimed job's modification time is its lease: the worker
+# that claimed it touches it while it works, and a job whose lease
+# runs out is moved back to pending/ for someone else to pick up.
+# Pending jobs are named after their position in the run, so they are
+# claimed in the order they were added.
+
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import List, Tuple, Optional, Dict
+
+Job = Tuple[str, str, str]
+
+
+def job_id(job: Job) -> str:
+    return hashlib.sha256(json.dumps(list(job)).encode('utf-8')).hexdigest()
+
+
+class FileJobQueue:
+    directory: str
+    lease_time: float
+
+    def __init__(self, directory: str, lease_time: float) -> None:
+        self.directory = directory
+        self.lease_time = lease_time
+        for subdir in ["pending", "claimed", "done"]:
+            os.makedirs(os.path.join(directory, subdir), exist_ok=True)
+
+    def path(self, state: str, jid: str) -> str:
+        return os.path.join(self.directory, state, jid + ".json")
+
+    def pending_path(self, order: int, jid: str) -> str:
+        return os.path.join(self.directory, "pending",
+                            f"{order:010d}-{jid}.json")
+
+    def pending_jobs(self) -> Dict[str, str]:
+        # Maps the id of each pending job to its path
+        return {name[:-len(".json")].split("-", 1)[1]:
+                os.path.join(self.directory, "pending", name)
+                for name in sorted(os.listdir(os.path.join(self.directory,
+                                                           "pending")))
+                if name.endswith(".json")}
+
+    def add_jobs(self, jobs: List[Job]) -> None:
+        # Every node of a run adds the same jobs, so adding one that is
+        # already somewhere in the queue does nothing.
+        pending = self.pending_jobs()
+        for order, job in enumerate(jobs):
+            jid = job_id(job)
+            if jid in pending or \
+               any(os.path.exists(self.path(state, jid))
+                   for state in ["claimed", "done"]):
+                continue
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.join(self.directory, "pending"))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"job": list(job), "order": order}, f)
+            os.replace(tmp_path, self.pending_path(order, jid))
+
+    def num_pending(self) -> int:
+        return len(self.pending_jobs())
+
+    def num_unfinished(self) -> int:
+        return self.num_pending() + \
+            len(os.listdir(os.path.join(self.directory, "claimed")))
+
+    def reissue_expired(self) -> None:
+        now = time.time()
+        for name in os.listdir(os.path.join(self.directory, "claimed")):
+            jid = name[:-len(".json")]
+            try:
+                if now - os.path.getmtime(self.path("claimed", jid)) \
+                   > self.lease_time:
+                    with open(self.path("claimed", jid), 'r') as f:
+                        order = json.load(f)["order"]
+                    os.rename(self.path("claimed", jid),
+                              self.pending_path(order, jid))
+            except FileNotFoundError:
+                # Someone else finished or reissued it first
+                pass
+
+    def claim(self) -> Optional[Job]:
+        self.reissue_expired()
+        for jid, path in self.pending_jobs().items():
+            try:
+                os.rename(path, self.path("claimed", jid))
+            except FileNotFoundError:
+                continue
+            # The rename keeps the old modification time, so start
+            # the lease now.
+            self.heartbeat(jid)
+            with open(self.path("claimed", jid), 'r') as f:
+                file, module, lemma = json.load(f)["job"]
+            return (file, module, lemma)
+        return None
+
+    def claim_report(self) -> bool:
+        # Once every job is done, each machine that notices tries to
+        # claim the report; only the first one writes it.
+        try:
+            fd = os.open(os.path.join(self.directory, "report.lock"),
+                         os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.close(fd)
+        return True
+
+    def heartbeat(self, jid: str) -> bool:
+        try:
+            os.utime(self.path("claimed", jid))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, job: Job) -> bool:
+        # Returns False if the job was already completed, so that a
+        # result from a worker whose lease ran out isn't recorded twice.
+        jid = job_id(job)
+        for path in [self.path("claimed", jid),
+                     self.pending_jobs().get(jid)]:
+            if path is None:
+                continue
+            try:
+                os.rename(path, self.path("done", jid))
+                return True
+            except FileNotFoundError:
+                pass
+        return False
+
+
+class LeasedJobs:
+    # Hands out jobs from a FileJobQueue to a single search worker,
+    # with the same get_nowait() interface as the in-memory job queue.
+    # A background thread keeps the lease on the most recently claimed
+    # job alive until the worker asks for its next one.
+    def __init__(self, directory: str, lease_time: float) -> None:
+        self.directory = directory
+        self.lease_time = lease_time
+        self.current_job: Optional[str] = None
+        self.heartbeat_thread: Optional[threading.Thread] = None
+
+    def get_nowait(self) -> Job:
+        # Unlike the in-memory queue, this waits while there are jobs
+        # claimed by other workers, in case one of their leases runs
+        # out; it only gives up once every job is done.
+        self.current_job = None
+        job_queue = FileJobQueue(self.directory, self.lease_time)
+        if not self.heartbeat_thread:
+            self.heartbeat_thread = threading.Thread(
+                target=self.heartbeat_loop, args=(job_queue,), daemon=True)
+            self.heartbeat_thread.start()
+        while True:
+            job = job_queue.claim()
+            if job is not None:
+                break
+            if job_queue.num_unfinished() == 0:
+                raise queue.Empty()
+            time.sleep(min(self.lease_time / 4, 10))
+        self.current_job = job_id(job)
+        return job
+
+    def heartbeat_loop(self, job_queue: FileJobQueue) -> None:
+        while True:
+            time.sleep(self.lease_time / 4)
+            current_job = self.current_job
+            if current_job:
+                job_queue.heartbeat(current_job)
@@ -29,6 +29,9 @@ class TacticPredictor(metaclass=ABCMeta):
     @abstractmethod
     def predictKTactics(self, in_data : TacticContext, k : int) \
         -> List[Prediction]: pass
+    def predictKTactics_batch(self, in_data : List[TacticContext], k : int) \
+        -> List[List[Prediction]]:
+        return [self.predictKTactics(context, k) for context in in_data]
     @abstractmethod
     def predictKTacticsWithLoss(self, in_data : TacticContext, k : int, correct : str) -> \
         Tuple[List[Prediction], float]: pass
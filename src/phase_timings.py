@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# Where the time in a search goes. Each phase of the search (asking
+# the model for predictions, running and cancelling statements in coq,
+# and so on) keeps a count, a total, and a histogram of how long each
+# call took, both for the lemma being searched and for the whole
+# worker.
+
+import contextlib
+import json
+import math
+import time
+from typing import Dict, Any, Iterator, List, Callable, TypeVar
+
+from coq_serapy import SerapiInstance
+
+PHASES = ["prediction", "run_stmt", "cancel_last", "proof context",
+          "context checks", "graph drawing"]
+
+T = TypeVar('T')
+
+
+class PhaseHistogram:
+    # Durations are bucketed by powers of two milliseconds, keyed on
+    # the bucket's upper bound.
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        bucket = 2 ** max(0, math.ceil(math.log2(max(seconds * 1000,
+                                                     1e-9))))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"count": self.count, "total": self.total,
+                "histogram_ms": {str(bucket): count for bucket, count
+                                 in sorted(self.buckets.items())}}
+
+
+class PhaseTimings:
+    def __init__(self) -> None:
+        self.lemma_phases: Dict[str, PhaseHistogram] = {}
+        self.worker_phases: Dict[str, PhaseHistogram] = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        for phases in [self.lemma_phases, self.worker_phases]:
+            if phase not in phases:
+                phases[phase] = PhaseHistogram()
+            phases[phase].add(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start_time)
+
+    def timed(self, phase: str, f: Callable[..., T], *args: Any) -> T:
+        with self.phase(phase):
+            return f(*args)
+
+    def start_lemma(self) -> None:
+        self.lemma_phases = {}
+
+    def lemma_summary(self) -> Dict[str, Any]:
+        return {phase: histogram.to_dict() for phase, histogram
+                in self.lemma_phases.items()}
+
+    def worker_summary(self) -> Dict[str, Any]:
+        return {phase: histogram.to_dict() for phase, histogram
+                in self.worker_phases.items()}
+
+
+class TimedSerapiInstance:
+    # Stands in for a SerapiInstance (or a pool of them), recording how
+    # long the search spends waiting on coq.
+    def __init__(self, coq: SerapiInstance, timings: PhaseTimings) -> None:
+        object.__setattr__(self, "coq", coq)
+        object.__setattr__(self, "timings", timings)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.coq, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self.coq, name, value)
+
+    def __len__(self) -> int:
+        return len(self.coq)  # type: ignore
+
+    def run_stmt(self, *args, **kwargs) -> None:
+        with self.timings.phase("run_stmt"):
+            self.coq.run_stmt(*args, **kwargs)
+
+    def cancel_last(self, *args, **kwargs) -> None:
+        with self.timings.phase("cancel_last"):
+            self.coq.cancel_last(*args, **kwargs)
+
+    @property
+    def proof_context(self) -> Any:
+        with self.timings.phase("proof context"):
+            return self.coq.proof_context
+
+    @property
+    def goals(self) -> Any:
+        with self.timings.phase("proof context"):
+            return self.coq.goals
+
+    @property
+    def hypotheses(self) -> Any:
+        with self.timings.phase("proof context"):
+            return self.coq.hypotheses
+
+    def count_fg_goals(self) -> int:
+        with self.timings.phase("proof context"):
+            return self.coq.count_fg_goals()
+
+
+def phase_totals(timings_files: List[Any]) -> Dict[str, float]:
+    # The total time spent in each phase over every lemma recorded in
+    # the given per-file JSONL timing files.
+    totals: Dict[str, float] = {}
+    for timings_file in timings_files:
+        try:
+            with open(timings_file, 'r') as f:
+                for line in f:
+                    for phase, histogram in json.loads(line)["phases"].items():
+                        totals[phase] = totals.get(phase, 0.0) + \
+                            histogram["total"]
+        except FileNotFoundError:
+            pass
+    return totals
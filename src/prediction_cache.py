@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A content-addressed cache around a TacticPredictor. Predictions are
+# keyed on a hash of the (already truncated) tactic context, the model
+# they came from, and k. There's an in-memory LRU tier, and optionally
+# an on-disk tier that any number of workers, runs, and machines can
+# share.
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from typing import List, Tuple, Optional, Any
+
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import TacticPredictor, Prediction
+from util import unwrap
+
+
+class CachingPredictor(TacticPredictor):
+    predictor: TacticPredictor
+    model_id: str
+    max_entries: int
+    cache_dir: Optional[str]
+
+    def __init__(self, predictor: TacticPredictor, model_id: str,
+                 max_entries: int, cache_dir: Optional[str] = None) -> None:
+        self.predictor = predictor
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.memory: 'OrderedDict[str, List[Prediction]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # Anything else (unparsed_args, training_args, ...) comes from
+        # the wrapped predictor.
+        if name == "predictor":
+            raise AttributeError(name)
+        return getattr(self.predictor, name)
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return self.predictor.getOptions()
+
+    def cache_key(self, context: TacticContext, k: int) -> str:
+        return hashlib.sha256(json.dumps(
+            [self.model_id, k, context.relevant_lemmas,
+             context.prev_tactics, context.hypotheses,
+             context.goal]).encode('utf-8')).hexdigest()
+
+    def predictKTactics(self, in_data: TacticContext, k: int) \
+            -> List[Prediction]:
+        return self.predictKTactics_batch([in_data], k)[0]
+
+    def predictKTactics_batch(self, in_data: List[TacticContext], k: int) \
+            -> List[List[Prediction]]:
+        keys = [self.cache_key(context, k) for context in in_data]
+        found = {key: self.lookup(key) for key in set(keys)}
+        missing = {key: context for key, context in zip(keys, in_data)
+                   if found[key] is None}
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            computed = self.predictor.predictKTactics_batch(
+                list(missing.values()), k)
+            for key, predictions in zip(missing.keys(), computed):
+                self.store(key, predictions)
+                found[key] = predictions
+        return [unwrap(found[key]) for key in keys]
+
+    def predictKTacticsWithLoss(self, in_data: TacticContext, k: int,
+                                correct: str) \
+            -> Tuple[List[Prediction], float]:
+        return self.predictKTactics(in_data, k), 0
+
+    def predictKTacticsWithLoss_batch(self,
+                                      in_data: List[TacticContext],
+                                      k: int, correct: List[str]) \
+            -> Tuple[List[List[Prediction]], float]:
+        return self.predictKTactics_batch(in_data, k), 0
+
+    def disk_path(self, key: str) -> str:
+        assert self.cache_dir
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def lookup(self, key: str) -> Optional[List[Prediction]]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.disk_path(key), 'r') as f:
+                predictions = [Prediction(prediction, certainty)
+                               for prediction, certainty in json.load(f)]
+        except (FileNotFoundError, ValueError):
+            return None
+        self.remember(key, predictions)
+        return predictions
+
+    def store(self, key: str, predictions: List[Prediction]) -> None:
+        self.remember(key, predictions)
+        if not self.cache_dir:
+            return
+        path = self.disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and move it into place, so that
+        # readers on other workers never see half an entry.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump([[prediction.prediction, prediction.certainty]
+                       for prediction in predictions], f)
+        os.replace(tmp_path, path)
+
+    def remember(self, key: str, predictions: List[Prediction]) -> None:
+        if self.max_entries <= 0:
+            return
+        self.memory[key] = predictions
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# Lets many search workers share one copy of a predictor. The process
+# that owns the model runs a PredictionServer thread, and each worker
+# gets a RemotePredictor that forwards its requests to it over a
+# queue. Requests that arrive together are answered with a single
+# batched call to the model.
+
+import multiprocessing
+import queue
+import threading
+from typing import List, Tuple, NamedTuple, Optional, Union
+
+from coq_serapy.contexts import TacticContext
+from models.tactic_predictor import TacticPredictor, Prediction
+from util import eprint
+
+
+class PredictionRequest(NamedTuple):
+    worker_idx: int
+    contexts: List[TacticContext]
+    k: int
+
+
+PredictionResponse = Union[List[List[Prediction]], Exception]
+
+
+class PredictionServer(threading.Thread):
+    predictor: TacticPredictor
+    requests: 'multiprocessing.Queue[Optional[PredictionRequest]]'
+    responses: 'List[multiprocessing.Queue[PredictionResponse]]'
+    max_batch_size: int
+
+    def __init__(self, predictor: TacticPredictor,
+                 num_workers: int, max_batch_size: int) -> None:
+        super().__init__(daemon=True)
+        self.predictor = predictor
+        self.requests = multiprocessing.Queue()
+        self.responses = [multiprocessing.Queue()
+                          for _ in range(num_workers)]
+        self.max_batch_size = max_batch_size
+        self.num_batches = 0
+        self.num_requests = 0
+
+    def remote_predictor(self, worker_idx: int) -> 'RemotePredictor':
+        return RemotePredictor(worker_idx, self.requests,
+                               self.responses[worker_idx],
+                               self.predictor.getOptions())
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            first_request = self.requests.get()
+            if first_request is None:
+                return
+            batch = [first_request]
+            num_contexts = len(first_request.contexts)
+            # Pick up whatever else is already waiting, so that
+            # concurrent requests share a forward pass.
+            while num_contexts < self.max_batch_size:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                num_contexts += len(request.contexts)
+            self.answer(batch)
+
+    def answer(self, batch: List[PredictionRequest]) -> None:
+        self.num_batches += 1
+        self.num_requests += len(batch)
+        for k in {request.k for request in batch}:
+            requests_with_k = [request for request in batch
+                               if request.k == k]
+            response: PredictionResponse
+            try:
+                # Not silenced: this is a thread of the main process,
+                # and swapping out sys.stdout and sys.stderr here would
+                # also drop everything the main thread prints meanwhile.
+                all_predictions = self.predictor.predictKTactics_batch(
+                    [context for request in requests_with_k
+                     for context in request.contexts], k)
+            except Exception as e:
+                eprint(f"Prediction server failed on a batch: {e}")
+                for request in requests_with_k:
+                    self.responses[request.worker_idx].put(e)
+                continue
+            for request in requests_with_k:
+                response = all_predictions[:len(request.contexts)]
+                all_predictions = all_predictions[len(request.contexts):]
+                self.responses[request.worker_idx].put(response)
+
+    def stop(self) -> None:
+        self.requests.put(None)
+        self.join()
+
+
+class RemotePredictor(TacticPredictor):
+    def __init__(self, worker_idx: int,
+                 requests: 'multiprocessing.Queue[Optional[PredictionRequest]]',
+                 responses: 'multiprocessing.Queue[PredictionResponse]',
+                 options: List[Tuple[str, str]]) -> None:
+        self.worker_idx = worker_idx
+        self.requests = requests
+        self.responses = responses
+        self.options = options
+
+    def getOptions(self) -> List[Tuple[str, str]]:
+        return self.options
+
+    def predictKTactics(self, in_data: TacticContext, k: int) \
+            -> List[Prediction]:
+        return self.predictKTactics_batch([in_data], k)[0]
+
+    def predictKTactics_batch(self, in_data: List[TacticContext], k: int) \
+            -> List[List[Prediction]]:
+        self.requests.put(PredictionRequest(self.worker_idx, in_data, k))
+        response = self.responses.get()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def predictKTacticsWithLoss(self, in_data: TacticContext, k: int,
+                                correct: str) \
+            -> Tuple[List[Prediction], float]:
+        return self.predictKTactics(in_data, k), 0
+
+    def predictKTacticsWithLoss_batch(self,
+                                      in_data: List[TacticContext],
+                                      k: int, correct: List[str]) \
+            -> Tuple[List[List[Prediction]], float]:
+        return self.predictKTactics_batch(in_data, k), 0
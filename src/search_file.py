@@ -32,14 +32,28 @@ import json
 import queue
 import traceback
 import subprocess
+import functools
+import zlib
 import cProfile
+import heapq
+import math
+import bisect
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, Future
 from typing import (List, Tuple, NamedTuple, Optional, Dict,
-                    Union, Callable, cast,
-                    Any)
+                    Union, Callable, Iterator, cast,
+                    Any, Set, TYPE_CHECKING)
 
 from models.tactic_predictor import TacticPredictor, Prediction
 from predict_tactic import (static_predictors, loadPredictorByFile,
                             loadPredictorByName)
+from prediction_server import PredictionServer
+from prediction_cache import CachingPredictor
+from serapi_pool import SerapiPool
+from job_queue import FileJobQueue, LeasedJobs
+from solution_store import SolutionStore, PrefixHashes
+from phase_timings import (PhaseTimings, TimedSerapiInstance, PHASES,
+                           phase_totals)
 import coq_serapy as serapi_instance
 from coq_serapy import (ProofContext, Obligation, SerapiInstance)
 
@@ -47,16 +61,18 @@ import data
 from coq_serapy.contexts import TacticContext, ScrapedTactic, truncate_tactic_context
 from util import (unwrap, eprint, escape_filename, escape_lemma_name,
                   mybarfmt, split_by_char_outside_matching, nostderr)
-import search_report
 import util
 from dataclasses import dataclass
 
 from tqdm import tqdm
-from yattag import Doc
 from pathlib_revised import Path2
 from enum import Enum
-import pygraphviz as pgv
-Tag = Callable[..., Doc.Tag]
+if TYPE_CHECKING:
+    # Only the main process writes reports, so workers don't import
+    # these.
+    import search_report
+    from yattag import Doc
+Tag = Callable[..., 'Doc.Tag']
 Text = Callable[..., None]
 Line = Callable[..., None]
 
@@ -112,6 +128,9 @@ class KilledException(Exception):
 class SearchResult(NamedTuple):
     status: SearchStatus
     commands: Optional[List[TacticInteraction]]
+    # Whether the search was cut off by the time limit; only used
+    # within a run, so it isn't saved.
+    timed_out: bool = False
 
     @classmethod
     def from_dict(cls, data):
@@ -137,14 +156,23 @@ unnamed_goal_number: int
 
 
 def main(arg_list: List[str]) -> None:
-    multiprocessing.set_start_method('spawn')
+    args, parser = parse_arguments(arg_list)
+    multiprocessing.set_start_method(args.start_method)
+    if args.start_method == 'forkserver':
+        # Workers are forked from a server that has already imported
+        # this script and everything it imports (torch, the predictor
+        # modules, and so on), so each one doesn't import them again.
+        multiprocessing.set_forkserver_preload(["__main__"])
     sys.setrecursionlimit(100000)
     global predictor
 
-    args, parser = parse_arguments(arg_list)
     util.use_cuda = False
     # with util.silent():
     predictor = get_predictor(parser, args)
+    if args.prediction_cache_size > 0 or args.prediction_cache_dir:
+        predictor = CachingPredictor(predictor, get_model_id(args),
+                                     args.prediction_cache_size,
+                                     args.prediction_cache_dir)
     base = Path2(os.path.dirname(os.path.abspath(__file__)))
 
     if not args.output_dir.exists():
@@ -171,6 +199,14 @@ def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
                         type=Path2)
     parser.add_argument("--no-generate-report", dest="generate_report",
                         action="store_false")
+    parser.add_argument("--draw-graphs", choices=["none", "failures", "all"],
+                        default="all",
+                        help="Which lemmas to draw search graphs for. "
+                        "Graphs are drawn by a separate process, off the "
+                        "search workers' critical path")
+    parser.add_argument("--report-processes", type=int, default=2,
+                        help="Number of processes writing the reports for "
+                        "files whose lemmas are all done")
     parser.add_argument("--verbose", "-v", help="verbose output",
                         action="count", default=0)
     parser.add_argument("--progress", "-P", help="show progress of files",
@@ -205,6 +241,24 @@ def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
     parser.add_argument("--max-proof-time", dest="max_proof_time",
                         type=float, default=300)
     parser.add_argument("--max-tactic-time", type=float, default=2)
+    parser.add_argument("--adaptive-timeouts", action='store_true',
+                        help="Give each candidate tactic only as long as "
+                        "tactics with the same stem have needed to succeed "
+                        "so far, up to --max-tactic-time")
+    parser.add_argument("--timeout-percentile", type=float, default=99,
+                        help="Percentile of a stem's run times (counting "
+                        "timeouts at their timeout) to use as its timeout "
+                        "with --adaptive-timeouts, but never less than its "
+                        "longest success")
+    parser.add_argument("--timeout-min-samples", type=int, default=20,
+                        help="Number of successes a stem needs before its "
+                        "timeout is adapted")
+    parser.add_argument("--min-tactic-time", type=float, default=0.5,
+                        help="Shortest timeout --adaptive-timeouts will give "
+                        "a tactic")
+    parser.add_argument("--timeouts-by-goal-size", action='store_true',
+                        help="With --adaptive-timeouts, keep separate "
+                        "success times for goals of different sizes")
     parser.add_argument("--linearize", action='store_true')
     parser.add_argument("--proof-times", default=None, type=Path2)
     parser.add_argument('filenames', help="proof file name (*.v)",
@@ -212,6 +266,11 @@ def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
     parser.add_argument("--use-hammer",
                         help="Use Hammer tactic after every predicted tactic",
                         action='store_const', const=True, default=False)
+    parser.add_argument("--async-hammer", action='store_true',
+                        help="Run hammer on each new obligation in a "
+                        "separate coq instance in the background, and only "
+                        "try it in the search on obligations it closed "
+                        "there")
     parser.add_argument("--include-proof-relevant", action="store_true")
     # parser.add_argument('--no-check-consistent', action='store_false',
     #                     dest='check_consistent')
@@ -235,28 +294,115 @@ def parse_arguments(args_list: List[str]) -> Tuple[argparse.Namespace,
     parser.add_argument("--add-env-lemmas", type=Path2, default=None)
     parser.add_argument("--add-axioms", type=Path2, default=None)
     parser.add_argument("--max-search-time-per-lemma", default=None, type=float)
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Total seconds to spend on the run. Lemmas "
+                        "are first searched for --initial-lemma-time "
+                        "seconds each, and the ones that run out of time "
+                        "are searched again with twice as long, until the "
+                        "budget is spent")
+    parser.add_argument("--initial-lemma-time", type=float, default=15)
+    parser.add_argument("--search-type", choices=['dfs', 'best-first'],
+                        default='dfs')
+    parser.add_argument("--min-certainty", type=float, default=0.0,
+                        help="Don't try candidates the model is less "
+                        "certain of than this")
+    parser.add_argument("--log-prob-beam", type=float, default=None,
+                        help="Don't try candidates whose path's total log "
+                        "certainty is more than this far below the best "
+                        "path to the same depth so far")
+    parser.add_argument("--transposition-table", action='store_true',
+                        help="Don't search proof states again that were "
+                        "already searched with as much depth left. "
+                        "Predictions depend on the tactics before them, "
+                        "so this can miss proofs")
+    parser.add_argument("--standby-coq", action='store_true',
+                        help="Keep a second coq instance per worker a "
+                        "lemma behind, to switch to after anomalies and "
+                        "timeouts instead of rerunning the file")
+    parser.add_argument("--subgoal-memo", action='store_true',
+                        help="Replay the tactics that closed a subgoal "
+                        "when the same subgoal comes up again in the "
+                        "same file")
+    parser.add_argument("--failure-memo", action='store_true',
+                        help="Remember which tactics failed on which "
+                        "goals across the lemmas of a file")
+    parser.add_argument("--prediction-server", action='store_true',
+                        help="Serve predictions for all workers from one "
+                        "copy of the model in the main process")
+    parser.add_argument("--max-prediction-batch", type=int, default=64)
+    parser.add_argument("--prediction-cache-size", type=int, default=0,
+                        help="Number of predictions to keep in memory, "
+                        "keyed on the tactic context, model, and k")
+    parser.add_argument("--prediction-cache-dir", default=None, type=str,
+                        help="Directory to share cached predictions "
+                        "through, across workers and runs")
+    parser.add_argument("--parallel-tactics", type=int, default=1,
+                        help="Number of coq instances to try candidate "
+                        "tactics on at once")
+    parser.add_argument("--search-batch-size", type=int, default=16,
+                        help="Number of frontier nodes to predict for at "
+                        "once in best-first search")
+    parser.add_argument("--no-pipelined-predictions",
+                        dest="pipelined_predictions", action='store_false',
+                        help="In best-first search, don't start predicting "
+                        "for new nodes while coq runs the tactics of their "
+                        "siblings")
+    parser.add_argument("--no-cost-ordering", dest="cost_ordering",
+                        action='store_false',
+                        help="Search files in the order they were given, "
+                        "instead of the files expected to take longest "
+                        "first")
+    parser.add_argument("--solution-store", default=None, type=str,
+                        help="Directory to keep found proofs in, so that "
+                        "later runs with the same model and search "
+                        "parameters only have to check them")
+    parser.add_argument("--start-method", default="forkserver",
+                        choices=["forkserver", "spawn", "fork"],
+                        help="How to start worker processes. With fork, "
+                        "workers share the main process's copy of the "
+                        "model instead of each being sent one")
+    parser.add_argument("--job-queue", default=None, type=str,
+                        help="Directory on a shared filesystem to take "
+                        "jobs from, so that several machines can work on "
+                        "the same run")
+    parser.add_argument("--lease-time", type=float, default=600,
+                        help="Seconds without a heartbeat before a job "
+                        "from --job-queue is given to another worker")
     if __name__ == "__main__":
         known_args = parser.parse_args(args_list)
     else:
         known_args, unknown_args = parser.parse_known_args(args_list)
+    if known_args.time_budget is not None and known_args.job_queue:
+        parser.error("--time-budget can't be used with --job-queue")
+    if known_args.use_hammer and known_args.async_hammer:
+        parser.error("--use-hammer can't be used with --async-hammer")
     return known_args, parser
 
 
 def produce_index(args: argparse.Namespace, predictor: TacticPredictor,
-                  report_stats: List[search_report.ReportStats]) -> None:
+                  report_stats: List['search_report.ReportStats']) -> None:
+    import search_report
     predictorOptions = predictor.getOptions()
     commit, date, weightshash = get_metadata(args)
+    time_in_phases = phase_totals([timings_file(args, filename)
+                                   for filename in args.filenames])
     search_report.write_summary(args,
                                 predictorOptions +
                                 [("report type", "search"),
                                  ("search width", args.search_width),
-                                 ("search depth", args.search_depth)],
+                                 ("search depth", args.search_depth)] +
+                                [(f"time in {phase}",
+                                  str(datetime.timedelta(
+                                      seconds=time_in_phases[phase])))
+                                 for phase in PHASES
+                                 if phase in time_in_phases],
                                 predictor.unparsed_args,
                                 commit, date, weightshash, report_stats)
 
 
 def stats_from_blocks(blocks: List[DocumentBlock], vfilename: str) \
-      -> search_report.ReportStats:
+      -> 'search_report.ReportStats':
+    import search_report
     num_proofs = 0
     num_proofs_failed = 0
     num_proofs_completed = 0
@@ -273,15 +419,90 @@ def stats_from_blocks(blocks: List[DocumentBlock], vfilename: str) \
 
 
 def get_metadata(args: argparse.Namespace) -> Tuple[str, datetime.datetime, str]:
-    cur_commit = subprocess.check_output(["git show --oneline | head -n 1"],
-                                         shell=True).decode('utf-8').strip()
     cur_date = datetime.datetime.now()
     if args.weightsfile:
-        weights_hash = str(subprocess.check_output(
-            ["sha256sum", args.weightsfile]))
+        weights_hash = weights_sha256(str(args.weightsfile))
     else:
         weights_hash = ""
-    return cur_commit, cur_date, weights_hash
+    return current_commit(), cur_date, weights_hash
+
+
+@functools.lru_cache(maxsize=None)
+def weights_sha256(weightsfile: str) -> str:
+    # The index is rewritten as each file finishes, so only hash the
+    # weights once.
+    return util.hash_file(weightsfile, "sha256")
+
+
+@functools.lru_cache(maxsize=None)
+def current_commit() -> str:
+    # The abbreviated hash and subject of the commit checked out in
+    # the current directory, read straight out of .git. Falls back to
+    # asking git when the commit is packed or the repository isn't laid
+    # out the usual way.
+    try:
+        git_dir = find_git_dir(os.getcwd())
+        with open(os.path.join(git_dir, "HEAD"), 'r') as f:
+            head = f.read().strip()
+        if head.startswith("ref: "):
+            head = resolve_git_ref(git_dir, head[len("ref: "):])
+        with open(os.path.join(git_dir, "objects", head[:2], head[2:]),
+                  'rb') as f:
+            commit = zlib.decompress(f.read()).decode('utf-8',
+                                                      errors='replace')
+        subject = commit.split("\n\n", 1)[1].splitlines()[0]
+        return f"{head[:7]} {subject}"
+    except (OSError, IndexError, zlib.error):
+        return subprocess.check_output(
+            ["git show --oneline | head -n 1"],
+            shell=True).decode('utf-8').strip()
+
+
+def find_git_dir(directory: str) -> str:
+    while not os.path.isdir(os.path.join(directory, ".git")):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            raise FileNotFoundError(".git")
+        directory = parent
+    return os.path.join(directory, ".git")
+
+
+def resolve_git_ref(git_dir: str, ref: str) -> str:
+    try:
+        with open(os.path.join(git_dir, ref), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        with open(os.path.join(git_dir, "packed-refs"), 'r') as f:
+            for line in f:
+                if line.rstrip("\n").endswith(" " + ref):
+                    return line.split()[0]
+        raise
+
+
+def get_model_id(args: argparse.Namespace) -> str:
+    if args.weightsfile:
+        return util.hash_file(str(args.weightsfile))
+    else:
+        return args.predictor
+
+
+def search_params(args: argparse.Namespace) -> Dict[str, str]:
+    # The settings that decide which proofs a search finds, for keying
+    # the solution store. Limits on the time for a whole lemma or run
+    # are left out, so that a proof found once is reused even when the
+    # run is given a different amount of time.
+    return {name: str(getattr(args, name)) for name in
+            ["search_type", "search_width", "search_depth", "max_attempts",
+             "hard_depth_limit", "max_tactic_time", "max_term_length",
+             "relevant_lemmas", "use_hammer", "async_hammer",
+             "add_env_lemmas",
+             "add_axioms", "truncate_semicolons", "min_certainty",
+             "log_prob_beam", "adaptive_timeouts", "timeout_percentile",
+             "timeout_min_samples", "min_tactic_time",
+             "timeouts_by_goal_size", "count_failing_predictions",
+             "count_softfail_predictions", "search_batch_size",
+             "transposition_table", "failure_memo", "subgoal_memo",
+             "pipelined_predictions"]}
 
 
 def get_predictor(parser: argparse.ArgumentParser,
@@ -311,6 +532,28 @@ def append_time(args: argparse.Namespace, action: str, seconds: float):
             f.write(f"{action}: {datetime.timedelta(seconds=seconds)}\n")
 
 
+def timings_file(args: argparse.Namespace, filename: str) -> Path2:
+    return args.output_dir / (util.safe_abbrev(Path2(filename),
+                                               args.filenames)
+                              + "-timings.jsonl")
+
+
+def write_lemma_timings(args: argparse.Namespace, worker_idx: int,
+                        timings: PhaseTimings,
+                        job: Tuple[str, str, str],
+                        status: SearchStatus) -> None:
+    filename, module_prefix, lemma_statement = job
+    with timings_file(args, filename).open('a') as f:
+        f.write(json.dumps({"file": filename, "module": module_prefix,
+                            "lemma": lemma_statement,
+                            "status": status.name,
+                            "phases": timings.lemma_summary()}))
+        f.write("\n")
+    with (args.output_dir / f"worker-{worker_idx}-timings.json")\
+            .open('w') as f:
+        json.dump(timings.worker_summary(), f)
+
+
 def search_file_worker_profiled(
         args: argparse.Namespace,
         predictor: TacticPredictor,
@@ -319,12 +562,24 @@ def search_file_worker_profiled(
         done:
         'multiprocessing.Queue['
         '  Tuple[Tuple[str, str, str], SearchResult]]',
-        worker_idx: int) -> None:
+        worker_idx: int,
+        graph_queue: Optional['multiprocessing.Queue[GraphJob]'],
+        deadline: Optional[float] = None) -> None:
     cProfile.runctx('search_file_worker(args, predictor, '
-                    'predictor_lock, jobs, done, worker_idx)',
+                    'predictor_lock, jobs, done, worker_idx, graph_queue, '
+                    'deadline)',
                     globals(), locals(), 'searchstats-{}'.format(worker_idx))
 
 
+def claim_job(jobs: 'multiprocessing.Queue[Tuple[str, str, str]]',
+              deadline: Optional[float]) -> Tuple[str, str, str]:
+    # Workers stop taking jobs once the run is out of time, rather than
+    # being killed, so that they never leave a queue's lock held.
+    if deadline is not None and time.time() >= deadline:
+        raise queue.Empty
+    return jobs.get_nowait()
+
+
 def search_file_worker(args: argparse.Namespace,
                        predictor: TacticPredictor,
                        predictor_lock: threading.Lock,
@@ -332,14 +587,29 @@ def search_file_worker(args: argparse.Namespace,
                        done:
                        'multiprocessing.Queue['
                        '  Tuple[Tuple[str, str, str], SearchResult]]',
-                       worker_idx: int) -> None:
+                       worker_idx: int,
+                       graph_queue:
+                       Optional['multiprocessing.Queue[GraphJob]'],
+                       deadline: Optional[float] = None) -> None:
     sys.setrecursionlimit(100000)
     util.use_cuda = False
     axioms_already_added = False
+    worker_state = WorkerState(
+        TacticFailureMemo() if args.failure_memo else None,
+        PhaseTimings(), graph_queue,
+        TacticTimeouts(args) if args.adaptive_timeouts else None,
+        SubgoalMemo() if args.subgoal_memo else None,
+        deadline=deadline)
+    solution_store = SolutionStore(args.solution_store, get_model_id(args),
+                                   search_params(args)) \
+        if args.solution_store else None
+    env_hashes = PrefixHashes()
 
     failing_lemma = ""
+    restarted_for_lemma = ""
     try:
-        next_file, next_module, next_lemma = jobs.get_nowait()
+        next_file, next_module, next_lemma = \
+            claim_job(jobs, worker_state.deadline)
     except queue.Empty:
         return
     with util.silent():
@@ -348,22 +618,56 @@ def search_file_worker(args: argparse.Namespace,
 
     rest_commands = all_commands
     while rest_commands:
-        with serapi_instance.SerapiContext(["sertop", "--implicit"],
-                                           serapi_instance.
-                                           get_module_from_filename(next_file),
-                                           str(args.prelude),
-                                           use_hammer=args.use_hammer) as coq:
-            coq.quiet = True
-            coq.verbose = args.verbose
+        if worker_state.subgoal_memo:
+            worker_state.subgoal_memo.start_file(next_file)
+        with RecoverableCoq(args, next_file, all_commands,
+                            worker_state.timings) as recoverable:
+            coq = recoverable.coq
+            worker_state.hammer = recoverable.hammer
+            # What this pass through the loop has done to coq, so that
+            # a standby instance can do the same once it's done
+            block_steps: List[CoqStep] = []
+            block_added_axioms = False
+
+            def take_over() -> bool:
+                # Switches to the standby instance, which is just
+                # before the lemma we were on.
+                nonlocal coq, rest_commands, block_steps
+                nonlocal axioms_already_added, block_added_axioms
+                new_coq = recoverable.take_over()
+                if not new_coq:
+                    return False
+                coq = new_coq
+                rest_commands = rest_before_block
+                block_steps = []
+                if block_added_axioms:
+                    axioms_already_added = False
+                    block_added_axioms = False
+                return True
 
             while next_lemma:
+                recoverable.follow(block_steps)
+                block_steps = []
+                block_added_axioms = False
+                rest_before_block = rest_commands
                 try:
                     rest_commands, run_commands = coq.run_into_next_proof(
                         rest_commands)
+                    block_steps.append(("run_into_next_proof",
+                                        len(rest_before_block)))
                     if not rest_commands:
+                        if restarted_for_lemma != next_lemma:
+                            # Jobs can come out of file order when they
+                            # are shared with other machines, so look
+                            # again from the top of the file.
+                            restarted_for_lemma = next_lemma
+                            rest_commands = all_commands
+                            break
                         eprint(f"Couldn't find lemma {next_lemma}!")
                         break
                 except serapi_instance.CoqAnomaly:
+                    if take_over():
+                        continue
                     with util.silent():
                         all_commands = serapi_instance.\
                             load_commands_preserve(
@@ -379,38 +683,77 @@ def search_file_worker(args: argparse.Namespace,
                 if lemma_statement == next_lemma:
                     if args.add_axioms and not axioms_already_added:
                         axioms_already_added = True
+                        block_added_axioms = True
                         coq.cancel_last()
+                        block_steps.append(("cancel_last", None))
                         with args.add_axioms.open('r') as f:
                             for signature in f:
                                 try:
                                     coq.run_stmt(signature)
                                     coq.run_stmt("Admitted.")
+                                    block_steps.append(("run_stmt",
+                                                        signature))
+                                    block_steps.append(("run_stmt",
+                                                        "Admitted."))
                                 except CoqExn:
                                     axiom_name = serapi_instance.lemma_name_from_statement(
                                         signature)
                                     eprint(f"Couldn't declare axiom {axiom_name} "
                                            f"at this point in the proof")
                         coq.run_stmt(lemma_statement)
+                        block_steps.append(("run_stmt", lemma_statement))
                     initial_context = coq.proof_context
                     empty_context = ProofContext([], [], [], [])
+                    lemma_idx = len(all_commands) - len(rest_commands) - 1
+                    if solution_store:
+                        solution_key = solution_store.key(all_commands,
+                                                          lemma_idx)
+                    worker_state.env_id = (
+                        next_file,
+                        env_hashes.prefix_hash(all_commands, lemma_idx))
                     try:
-                        search_status, tactic_solution = \
-                            attempt_search(args, lemma_statement,
-                                           coq.module_prefix,
-                                           coq, worker_idx,
-                                           predictor,
-                                           predictor_lock)
+                        worker_state.timings.start_lemma()
+                        stored_solution = replay_stored_solution(
+                            args, coq, solution_store, solution_key) \
+                            if solution_store else None
+                        if stored_solution:
+                            eprint(f"Reusing the stored proof of "
+                                   f"{next_lemma}",
+                                   guard=args.verbose >= 1)
+                            search_status, tactic_solution = \
+                                SearchStatus.SUCCESS, stored_solution
+                        else:
+                            recoverable.start_lemma(block_steps,
+                                                    lemma_statement)
+                            search_status, tactic_solution = \
+                                attempt_search(args, lemma_statement,
+                                               coq.module_prefix,
+                                               coq, worker_idx,
+                                               predictor,
+                                               predictor_lock,
+                                               worker_state)
+                            if solution_store and tactic_solution and \
+                               search_status == SearchStatus.SUCCESS:
+                                solution_store.store(
+                                    solution_key,
+                                    [interaction.tactic for interaction
+                                     in tactic_solution])
                     except KilledException:
                         solution = [
                             TacticInteraction("Proof.", initial_context),
                             TacticInteraction("Admitted.", initial_context)
                         ]
+                        write_lemma_timings(args, worker_idx,
+                                            worker_state.timings,
+                                            (next_file, coq.module_prefix,
+                                             next_lemma),
+                                            SearchStatus.INCOMPLETE)
                         done.put(((next_file, coq.module_prefix,
                                    next_lemma),
                                   SearchResult(SearchStatus.INCOMPLETE,
-                                               solution)))
+                                               solution, timed_out=True)))
                         try:
-                            next_job = jobs.get_nowait()
+                            next_job = claim_job(jobs, worker_state.deadline)
                         except queue.Empty:
                             return
                         new_file, next_module, next_lemma = next_job
@@ -422,6 +765,8 @@ def search_file_worker(args: argparse.Namespace,
                                         args, 0,
                                         args.prelude / next_file)
                             rest_commands = all_commands
+                        elif take_over():
+                            continue
                         else:
                             rest_commands = all_commands
                         break
@@ -447,12 +792,19 @@ def search_file_worker(args: argparse.Namespace,
                                 TacticInteraction("Proof.", initial_context),
                                 TacticInteraction("Admitted.", initial_context)
                             ]
+                            write_lemma_timings(args, worker_idx,
+                                                worker_state.timings,
+                                                (next_file,
+                                                 coq.module_prefix,
+                                                 next_lemma),
+                                                SearchStatus.INCOMPLETE)
                             done.put(((next_file, coq.module_prefix,
                                        next_lemma),
                                       SearchResult(SearchStatus.INCOMPLETE,
                                                    solution)))
                             try:
-                                next_job = jobs.get_nowait()
+                                next_job = claim_job(
+                                    jobs, worker_state.deadline)
                             except queue.Empty:
                                 return
                             new_file, next_module, next_lemma = next_job
@@ -465,16 +817,21 @@ def search_file_worker(args: argparse.Namespace,
                                             args.prelude / next_file)
                                 rest_commands = all_commands
                                 break
+                            elif take_over():
+                                continue
                             else:
                                 rest_commands = all_commands
                         else:
-                            rest_commands = all_commands
                             failing_lemma = lemma_statement
+                            if take_over():
+                                continue
+                            rest_commands = all_commands
                         break
                     except Exception:
                         eprint(f"FAILED in file {next_file}, lemma {next_lemma}")
                         raise
                     serapi_instance.admit_proof(coq, lemma_statement)
+                    block_steps.append(("admit_proof", lemma_statement))
                     if not tactic_solution:
                         solution = [
                             TacticInteraction("Proof.", initial_context),
@@ -484,13 +841,15 @@ def search_file_worker(args: argparse.Namespace,
                             [TacticInteraction("Proof.", initial_context)]
                             + tactic_solution +
                             [TacticInteraction("Qed.", empty_context)])
-                    while not serapi_instance.ending_proof(rest_commands[0]):
-                        rest_commands = rest_commands[1:]
-                    rest_commands = rest_commands[1:]
+                    rest_commands = skip_proof(rest_commands)
+                    write_lemma_timings(args, worker_idx,
+                                        worker_state.timings,
+                                        (next_file, next_module, next_lemma),
+                                        search_status)
                     done.put(((next_file, next_module, next_lemma),
                               SearchResult(search_status, solution)))
                     try:
-                        next_job = jobs.get_nowait()
+                        next_job = claim_job(jobs, worker_state.deadline)
                     except queue.Empty:
                         return
                     new_file, next_module, next_lemma = next_job
@@ -522,6 +881,8 @@ def search_file_worker(args: argparse.Namespace,
                             serapi_instance.kill_comments(lemma_statement))) or \
                         args.careful
                     if proof_relevant:
+                        block_steps.append(("finish_proof",
+                                            len(rest_commands)))
                         rest_commands, run_commands = coq.finish_proof(
                             rest_commands)
                     else:
@@ -532,36 +893,634 @@ def search_file_worker(args: argparse.Namespace,
                                 serapi_instance.lemma_name_from_statement(next_lemma)
                             eprint(f"{next_file}: Failed to admit proof {next_lemma_name}")
                             raise
-                        while not serapi_instance.ending_proof(
-                                rest_commands[0]):
-                            rest_commands = rest_commands[1:]
-                        rest_commands = rest_commands[1:]
+                        block_steps.append(("admit_proof", lemma_statement))
+                        rest_commands = skip_proof(rest_commands)
 
                 pass
 
     pass
 
 
+def replay_stored_solution(args: argparse.Namespace,
+                           coq: SerapiInstance,
+                           solution_store: SolutionStore,
+                           key: str) -> Optional[List[TacticInteraction]]:
+    # Runs the stored proof for a lemma, if there is one. If it still
+    # proves the lemma, returns it with the context before each tactic;
+    # otherwise takes it back off coq.
+    tactics = solution_store.lookup(key)
+    if not tactics:
+        return None
+    solution: List[TacticInteraction] = []
+    for tactic in tactics:
+        context_before = coq.proof_context
+        try:
+            coq.run_stmt(tactic, timeout=time_per_tactic(args, coq, tactic))
+        except (serapi_instance.TimeoutError, serapi_instance.ParseError,
+                serapi_instance.CoqExn, serapi_instance.OverflowError,
+                RecursionError,
+                serapi_instance.UnrecognizedError):
+            break
+        solution.append(TacticInteraction(tactic, unwrap(context_before)))
+    else:
+        if completed_proof(coq):
+            return solution
+    eprint("Stored proof no longer works, searching again",
+           guard=args.verbose >= 1)
+    for _ in solution:
+        coq.cancel_last()
+    return None
+
+
+def skip_proof(rest_commands: List[str]) -> List[str]:
+    # The commands after the end of the proof we're in
+    while not serapi_instance.ending_proof(rest_commands[0]):
+        rest_commands = rest_commands[1:]
+    return rest_commands[1:]
+
+
+# A step the worker took in coq, as (kind, argument). Steps that take
+# the rest of the file's commands store how many commands were left,
+# since it's the same file on both instances.
+CoqStep = Tuple[str, Any]
+
+
+def run_coq_step(coq: SerapiInstance, all_commands: List[str],
+                 step: CoqStep) -> None:
+    kind, arg = step
+    if kind == "run_into_next_proof":
+        coq.run_into_next_proof(all_commands[len(all_commands) - arg:])
+    elif kind == "finish_proof":
+        coq.finish_proof(all_commands[len(all_commands) - arg:])
+    elif kind == "admit_proof":
+        serapi_instance.admit_proof(coq, arg)
+    elif kind == "run_stmt":
+        coq.run_stmt(arg)
+    else:
+        assert kind == "cancel_last", kind
+        coq.cancel_last()
+
+
+class StandbyCoq(threading.Thread):
+    # A coq instance in a background thread that takes the same steps
+    # as the worker's instance, a lemma behind it.
+    def __init__(self, args: argparse.Namespace, filename: str,
+                 all_commands: List[str], history: List[CoqStep]) -> None:
+        super().__init__(daemon=True)
+        self.args = args
+        self.filename = filename
+        self.all_commands = all_commands
+        self.steps: 'queue.Queue[Optional[CoqStep]]' = queue.Queue()
+        for step in history:
+            self.steps.put(step)
+        self.stack = contextlib.ExitStack()
+        self.coq: Optional[SerapiInstance] = None
+        self.error: Optional[Exception] = None
+        self.stopping = False
+        self.start()
+
+    def run(self) -> None:
+        try:
+            self.coq = self.stack.enter_context(
+                worker_coq_context(self.args, self.filename,
+                                   PhaseTimings()))
+            self.coq.quiet = True
+            while not self.stopping:
+                step = self.steps.get()
+                if step is None:
+                    return
+                run_coq_step(self.coq, self.all_commands, step)
+        except Exception as e:
+            self.error = e
+
+    def follow(self, steps: List[CoqStep]) -> None:
+        for step in steps:
+            self.steps.put(step)
+
+    def caught_up(self) -> Tuple[contextlib.ExitStack, SerapiInstance]:
+        # Waits for the standby to take all of its steps, and hands
+        # over the instance along with what closes it.
+        self.steps.put(None)
+        self.join()
+        if self.error:
+            self.stack.close()
+            raise self.error
+        return self.stack, unwrap(self.coq)
+
+    def close(self) -> None:
+        self.stopping = True
+        self.steps.put(None)
+        self.join()
+        self.stack.close()
+
+
+class RecoverableCoq:
+    # The worker's coq instance for a file. With --standby-coq it comes
+    # with a standby instance that follows it a lemma behind, so that
+    # after an anomaly or a timeout the worker can carry on from just
+    # before the lemma it was on, instead of starting a new instance
+    # and running the file again from the top.
+    def __init__(self, args: argparse.Namespace, filename: str,
+                 all_commands: List[str], timings: PhaseTimings) -> None:
+        self.args = args
+        self.filename = filename
+        self.all_commands = all_commands
+        self.timings = timings
+        self.history: List[CoqStep] = []
+        self.standby: Optional[StandbyCoq] = None
+        self.hammer: Optional[AsyncHammer] = None
+
+    def __enter__(self) -> 'RecoverableCoq':
+        self.stack = contextlib.ExitStack()
+        self.coq = self.stack.enter_context(
+            worker_coq_context(self.args, self.filename, self.timings))
+        self.coq.quiet = True
+        self.coq.verbose = self.args.verbose
+        if self.args.standby_coq:
+            self.standby = StandbyCoq(self.args, self.filename,
+                                      self.all_commands, [])
+        if self.args.async_hammer:
+            self.hammer = AsyncHammer(self.args, self.filename,
+                                      self.all_commands)
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        if self.standby:
+            self.standby.close()
+        if self.hammer:
+            self.hammer.close()
+        self.stack.close()
+
+    def follow(self, steps: List[CoqStep]) -> None:
+        self.history.extend(steps)
+        if self.standby:
+            self.standby.follow(steps)
+
+    def start_lemma(self, block_steps: List[CoqStep],
+                    lemma_statement: str) -> None:
+        # Brings the hammer instance up to the lemma about to be
+        # searched; block_steps are the steps taken since the last
+        # follow().
+        if self.hammer:
+            self.hammer.start_lemma(self.history + block_steps,
+                                    lemma_statement)
+
+    def take_over(self) -> Optional[SerapiInstance]:
+        if not self.standby:
+            return None
+        try:
+            new_stack, new_coq = self.standby.caught_up()
+        except Exception as e:
+            eprint(f"Standby coq failed ({e}), restarting from the top "
+                   f"of the file", guard=self.args.verbose >= 1)
+            self.standby = None
+            return None
+        eprint("Switching to the standby coq", guard=self.args.verbose >= 1)
+        self.stack.close()
+        self.stack = new_stack
+        # The standby recorded its timings separately
+        self.coq = cast(SerapiInstance, TimedSerapiInstance(
+            cast(TimedSerapiInstance, new_coq).coq, self.timings))
+        self.coq.verbose = self.args.verbose
+        self.standby = StandbyCoq(self.args, self.filename,
+                                  self.all_commands, self.history)
+        return self.coq
+
+
+HAMMER_TACTIC = "hammer."
+
+
+def obligation_goal(obligation: Obligation) -> str:
+    # The obligation as a goal of its own, with its hypotheses as
+    # arguments. Let-bound hypotheses lose their bodies, which only
+    # makes the goal harder; either way the search runs hammer on the
+    # real obligation before taking its word for it.
+    binders = "".join(
+        f" ({serapi_instance.get_var_term_in_hyp(hyp).replace(',', '')} "
+        f": {serapi_instance.get_hyp_type(hyp)})"
+        for hyp in obligation.hypotheses)
+    if binders:
+        return f"Goal forall{binders}, {obligation.goal}."
+    return f"Goal {obligation.goal}."
+
+
+class AsyncHammer(threading.Thread):
+    # A coq instance in a background thread that runs hammer on the
+    # obligations the search comes across, so that the search itself
+    # only spends time on hammer where it's known to work. The instance
+    # takes the same steps as the worker's up to the lemma being
+    # searched, then takes the lemma statement back off, so that each
+    # obligation can be stated as a goal on its own. The most recently
+    # submitted obligations are tried first, since they're the closest
+    # to where the search is.
+    def __init__(self, args: argparse.Namespace, filename: str,
+                 all_commands: List[str]) -> None:
+        super().__init__(daemon=True)
+        self.args = args
+        self.filename = filename
+        self.all_commands = all_commands
+        self.cond = threading.Condition()
+        # The steps still to take, and the worker's steps taken so far
+        # (or about to be)
+        self.steps: List[CoqStep] = []
+        self.followed: List[CoqStep] = []
+        self.lemma_statement: Optional[str] = None
+        self.obligations: List[Tuple[ObligationKey, Obligation]] = []
+        self.tried: Set[ObligationKey] = set()
+        self.proved: Set[ObligationKey] = set()
+        self.stopping = False
+        self.start()
+
+    def run(self) -> None:
+        try:
+            with serapi_context(self.args, self.filename,
+                                use_hammer=True) as coq:
+                coq.quiet = True
+                while True:
+                    with self.cond:
+                        while not self.stopping and not self.steps and \
+                              not self.obligations:
+                            self.cond.wait()
+                        if self.stopping:
+                            return
+                        if self.steps:
+                            step: Optional[CoqStep] = self.steps.pop(0)
+                        else:
+                            step = None
+                            key, obligation = self.obligations.pop()
+                    if step:
+                        run_coq_step(coq, self.all_commands, step)
+                    elif key not in self.tried:
+                        self.tried.add(key)
+                        if self.try_hammer(coq, obligation):
+                            self.proved.add(key)
+        except Exception as e:
+            eprint(f"Hammer coq failed ({e}), carrying on without it",
+                   guard=self.args.verbose >= 1)
+            with self.cond:
+                self.stopping = True
+
+    def try_hammer(self, coq: SerapiInstance, obligation: Obligation) \
+            -> bool:
+        try:
+            coq.run_stmt(obligation_goal(obligation))
+        except (serapi_instance.CoqExn, serapi_instance.ParseError):
+            # Goals with existential variables in them, for instance
+            return False
+        try:
+            coq.run_stmt(HAMMER_TACTIC, timeout=time_per_tactic(
+                self.args, coq, HAMMER_TACTIC))
+            proved = True
+            coq.cancel_last()
+        except (serapi_instance.TimeoutError, serapi_instance.ParseError,
+                serapi_instance.CoqExn, serapi_instance.OverflowError,
+                RecursionError,
+                serapi_instance.UnrecognizedError):
+            proved = False
+        coq.cancel_last()
+        return proved
+
+    def start_lemma(self, steps: List[CoqStep],
+                    lemma_statement: str) -> None:
+        # Takes the worker's steps (all of them, from the top of the
+        # file) that it hasn't taken yet, and drops the obligations of
+        # the last lemma.
+        with self.cond:
+            if self.stopping:
+                return
+            if steps[:len(self.followed)] != self.followed:
+                eprint("Hammer coq lost track of the worker, stopping it",
+                       guard=self.args.verbose >= 1)
+                self.stopping = True
+                self.cond.notify()
+                return
+            if self.lemma_statement:
+                self.steps.append(("run_stmt", self.lemma_statement))
+            self.steps.extend(steps[len(self.followed):])
+            self.steps.append(("cancel_last", None))
+            self.followed = list(steps)
+            self.lemma_statement = lemma_statement
+            self.obligations = []
+            self.cond.notify()
+
+    def submit(self, obligation: Obligation) -> None:
+        key = obligation_key(obligation)
+        if key in self.tried:
+            return
+        with self.cond:
+            self.obligations.append((key, obligation))
+            self.cond.notify()
+
+    def proves(self, obligation: Obligation) -> bool:
+        return obligation_key(obligation) in self.proved
+
+    def close(self) -> None:
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.join()
+
+
+def serapi_context(args: argparse.Namespace, filename: str,
+                   use_hammer: bool) -> serapi_instance.SerapiContext:
+    return serapi_instance.SerapiContext(
+        ["sertop", "--implicit"],
+        serapi_instance.get_module_from_filename(filename),
+        str(args.prelude),
+        use_hammer=use_hammer)
+
+
+@contextlib.contextmanager
+def worker_coq_context(args: argparse.Namespace, filename: str,
+                       timings: PhaseTimings) \
+        -> Iterator[SerapiInstance]:
+    # With --async-hammer the search runs hammer itself on the
+    # obligations it's known to close, so it needs it loaded too.
+    use_hammer = args.use_hammer or args.async_hammer
+    if args.parallel_tactics <= 1:
+        with serapi_context(args, filename, use_hammer) as coq:
+            yield cast(SerapiInstance, TimedSerapiInstance(coq, timings))
+    else:
+        with contextlib.ExitStack() as stack:
+            instances = [stack.enter_context(
+                serapi_context(args, filename, use_hammer))
+                         for _ in range(args.parallel_tactics)]
+            with SerapiPool(instances) as pool:
+                yield cast(SerapiInstance,
+                           TimedSerapiInstance(
+                               cast(SerapiInstance, pool), timings))
+
+
 def recover_sol(sol: Dict[str, Any]) -> SearchResult:
     return SearchResult.from_dict(sol)
 
 
+class LazySearchResult:
+    # A solution read back from a -proofs.txt file. Resuming only needs
+    # to know which lemmas are done, so the tactics (and their
+    # contexts) aren't rebuilt until a report asks for them.
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.data = data
+        self.result: Optional[SearchResult] = None
+
+    @property
+    def status(self) -> SearchStatus:
+        return SearchStatus(self.data['status'])
+
+    @property
+    def commands(self) -> Optional[List[TacticInteraction]]:
+        if self.result is None:
+            self.result = recover_sol(self.data)
+        return self.result.commands
+
+
+# A finished lemma's result, either from this run or read back from a
+# -proofs.txt file
+Solution = Union[SearchResult, LazySearchResult]
+
+
+def estimate_lemma_costs(args: argparse.Namespace, filename: Path2,
+                         cmds: List[str],
+                         lemma_statements: List[Tuple[str, str]]) \
+        -> Dict[Tuple[str, str], float]:
+    # Lemmas searched in an earlier run are expected to take as long as
+    # they did then. The rest are guessed from the length of their
+    # original proof, scaled to match the lemmas that have a history.
+    past_times: Dict[Tuple[str, str], float] = {}
+    try:
+        with timings_file(args, str(filename)).open('r') as f:
+            for line in f:
+                lemma_timings = json.loads(line)
+                past_times[(lemma_timings["module"],
+                            lemma_timings["lemma"])] = \
+                    sum(phase["total"] for phase
+                        in lemma_timings["phases"].values())
+    except FileNotFoundError:
+        pass
+
+    statements = {stmt for _, stmt in lemma_statements}
+    proof_lengths: Dict[str, int] = {}
+    cur_stmt: Optional[str] = None
+    for cmd in cmds:
+        if cur_stmt is not None:
+            if serapi_instance.ending_proof(cmd):
+                cur_stmt = None
+            else:
+                proof_lengths[cur_stmt] += 1
+        elif cmd in statements:
+            cur_stmt = cmd
+            proof_lengths[cur_stmt] = 1
+
+    known = [lemma for lemma in lemma_statements if lemma in past_times]
+    if known:
+        seconds_per_step = \
+            sum(past_times[lemma] for lemma in known) / \
+            sum(proof_lengths.get(lemma[1], 1) for lemma in known)
+    else:
+        seconds_per_step = 1.0
+    return {lemma: past_times[lemma] if lemma in past_times
+            else seconds_per_step * proof_lengths.get(lemma[1], 1)
+            for lemma in lemma_statements}
+
+
+def proofs_file_solutions(proofs_file: Path2) \
+        -> List[Tuple[Tuple[str, str, str], Solution]]:
+    solutions: List[Tuple[Tuple[str, str, str], Solution]] = []
+    seen: Set[Tuple[str, str, str]] = set()
+    try:
+        with proofs_file.open('r') as f:
+            for line in f:
+                (filename, module_prefix, lemma_stmt), sol = \
+                    json.loads(line)
+                # With a shared job queue, a worker whose lease ran out
+                # can append a result after the job was finished by
+                # someone else; the first one counts.
+                if (filename, module_prefix, lemma_stmt) in seen:
+                    continue
+                seen.add((filename, module_prefix, lemma_stmt))
+                solutions.append(((filename, module_prefix, lemma_stmt),
+                                  LazySearchResult(sol)))
+    except FileNotFoundError:
+        pass
+    return solutions
+
+
+def run_search_workers(args: argparse.Namespace,
+                       predictor: TacticPredictor,
+                       predictor_lock: threading.Lock,
+                       all_jobs: List[Tuple[str, str, str]],
+                       job_queue: Optional[FileJobQueue],
+                       deadline: Optional[float] = None) \
+        -> Iterator[Tuple[Tuple[str, str, str], SearchResult]]:
+    # Searches the given jobs (or, with a shared job queue, whatever
+    # jobs are left in it) on a fresh set of workers, yielding each
+    # result as it comes in. At the deadline, the workers cut short the
+    # lemma they're on and stop, and the jobs nobody got to come back as
+    # timed out.
+    done: Queue[
+        Tuple[Tuple[str, str, str], SearchResult]
+    ] = multiprocessing.Queue()
+    worker_jobs: Any
+    if job_queue:
+        num_jobs = job_queue.num_unfinished()
+        worker_jobs = LeasedJobs(args.job_queue, args.lease_time)
+    else:
+        num_jobs = len(all_jobs)
+        worker_jobs = multiprocessing.Queue()
+        for job in all_jobs:
+            worker_jobs.put(job)
+    num_workers = min(args.num_threads, num_jobs)
+    if args.prediction_server:
+        # Workers forward their predictions to a thread here
+        # instead of each getting a copy of the model.
+        server = PredictionServer(predictor, num_workers,
+                                  args.max_prediction_batch)
+        server.start()
+        worker_predictors: List[TacticPredictor] = \
+            [server.remote_predictor(widx)
+             for widx in range(num_workers)]
+    else:
+        worker_predictors = [predictor] * num_workers
+    graph_queue: Optional['multiprocessing.Queue[GraphJob]'] = None
+    if args.draw_graphs != "none":
+        graph_queue = multiprocessing.Queue()
+        renderer = multiprocessing.Process(target=render_graphs,
+                                           args=(graph_queue,))
+        renderer.start()
+    workers = [multiprocessing.Process(target=search_file_worker,
+                                       args=(args,
+                                             worker_predictors[widx],
+                                             predictor_lock,
+                                             worker_jobs, done, widx,
+                                             graph_queue, deadline))
+               for widx in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    finished: Set[Tuple[str, str, str]] = set()
+    for job, sol in finished_jobs(done, workers,
+                                  None if job_queue or deadline
+                                  else num_jobs):
+        finished.add(job)
+        yield job, sol
+    for worker in workers:
+        worker.join()
+    if not job_queue and len(finished) < num_jobs:
+        eprint(f"Out of time with {num_jobs - len(finished)} lemmas left",
+               guard=args.verbose >= 1)
+        # Nobody will take the rest of the jobs off the queue
+        worker_jobs.cancel_join_thread()
+        for job in all_jobs:
+            if job not in finished:
+                yield job, unfinished_result()
+    if graph_queue:
+        graph_queue.put(None)
+        renderer.join()
+    if args.prediction_server:
+        server.stop()
+        eprint(f"Prediction server answered {server.num_requests} "
+               f"requests in {server.num_batches} batches",
+               guard=args.verbose >= 1)
+        if isinstance(predictor, CachingPredictor):
+            eprint(f"Prediction cache had {predictor.hits} hits and "
+                   f"{predictor.misses} misses",
+                   guard=args.verbose >= 1)
+
+
+def run_anytime_rounds(args: argparse.Namespace,
+                       predictor: TacticPredictor,
+                       predictor_lock: threading.Lock,
+                       all_jobs: List[Tuple[str, str, str]],
+                       record_solution: Callable[[Tuple[str, str, str],
+                                                  SearchResult], None]) \
+        -> None:
+    # Searches every lemma with a small time limit first, then goes
+    # back to the ones that ran out of time with twice the limit, and
+    # so on, until they are all done or the run's time budget is spent.
+    # That way the easy lemmas in every file get solved before any time
+    # goes into the hard ones.
+    deadline = time.time() + args.time_budget
+    job_order = {job: idx for idx, job in enumerate(all_jobs)}
+    round_jobs = all_jobs
+    lemma_time = args.initial_lemma_time
+    last_results: Dict[Tuple[str, str, str], SearchResult] = {}
+    while round_jobs and time.time() < deadline:
+        round_lemma_time = min(lemma_time, deadline - time.time())
+        if args.max_search_time_per_lemma:
+            round_lemma_time = min(round_lemma_time,
+                                   args.max_search_time_per_lemma)
+        eprint(f"Searching {len(round_jobs)} lemmas for up to "
+               f"{round_lemma_time:.1f}s each", guard=args.verbose >= 1)
+        round_args = argparse.Namespace(**vars(args))
+        round_args.max_search_time_per_lemma = round_lemma_time
+        round_args.max_proof_time = min(args.max_proof_time,
+                                        round_lemma_time)
+        can_retry = round_lemma_time == lemma_time and \
+            (not args.max_search_time_per_lemma or
+             lemma_time < args.max_search_time_per_lemma)
+        timed_out = []
+        for job, sol in run_search_workers(round_args, predictor,
+                                           predictor_lock, round_jobs,
+                                           None, deadline):
+            if sol.timed_out and can_retry:
+                last_results[job] = sol
+                timed_out.append(job)
+            else:
+                last_results.pop(job, None)
+                record_solution(job, sol)
+        # Workers move through each file from top to bottom, so keep
+        # the jobs in their original order.
+        round_jobs = sorted(timed_out, key=lambda job: job_order[job])
+        lemma_time *= 2
+    for job in round_jobs:
+        # Jobs the budget ran out before searching at all have no
+        # result yet
+        record_solution(job, last_results[job] if job in last_results
+                        else unfinished_result())
+
+
+def unfinished_result() -> SearchResult:
+    # The result for a lemma whose search never finished because the
+    # run ran out of time, without the context a worker would have
+    # recorded
+    empty_context = ProofContext([], [], [], [])
+    return SearchResult(SearchStatus.INCOMPLETE,
+                        [TacticInteraction("Proof.", empty_context),
+                         TacticInteraction("Admitted.", empty_context)],
+                        timed_out=True)
+
+
+def finished_jobs(done: 'multiprocessing.Queue['
+                  '  Tuple[Tuple[str, str, str], SearchResult]]',
+                  workers: List[multiprocessing.Process],
+                  num_jobs: Optional[int]) \
+        -> Iterator[Tuple[Tuple[str, str, str], SearchResult]]:
+    # When we know how many jobs there are, wait for each of them.
+    # Otherwise (the jobs are shared with other machines, or the
+    # workers may stop early at a deadline), keep going until all of
+    # our workers have stopped.
+    if num_jobs is not None:
+        for _ in range(num_jobs):
+            yield done.get()
+        return
+    while True:
+        workers_alive = any(worker.is_alive() for worker in workers)
+        try:
+            yield done.get(timeout=1)
+        except queue.Empty:
+            if not workers_alive:
+                return
+
+
 def search_file_multithreaded(args: argparse.Namespace,
                               predictor: TacticPredictor) -> None:
     with multiprocessing.Manager() as manager:
-        jobs: Queue[
-            Tuple[str, str, str]] = multiprocessing.Queue()
-        done: Queue[
-            Tuple[Tuple[str, str, str], SearchResult]
-        ] = multiprocessing.Queue()
-
         # This cast appears to be needed due to a buggy type stub on
         # multiprocessing.Manager()
         predictor_lock = cast(multiprocessing.managers.SyncManager,
                               manager).Lock()
 
-        all_jobs: List[Tuple[str, str, str]] = []
-        file_solutions: List[List[Tuple[Tuple[str, str, str], SearchResult]]
+        file_jobs: List[Tuple[float, List[Tuple[str, str, str]]]] = []
+        file_solutions: List[List[Tuple[Tuple[str, str, str], Solution]]
                              ] = [list() for _ in range(len(args.filenames))]
 
         for filename, solutions in zip(args.filenames, file_solutions):
@@ -573,28 +1532,34 @@ def search_file_multithreaded(args: argparse.Namespace,
             all_lemma_statements = serapi_instance.lemmas_in_file(
                 filename, cmds, args.include_proof_relevant)
             lemma_statements_todo = list(all_lemma_statements)
-
-            if args.resume:
-                try:
-                    with proofs_file.open('r') as f:
-                        eprint(f"Resuming from {str(proofs_file)}", guard=args.verbose >= 1)
-                        for line in f:
-                            (filename, module_prefix, done_lemma_stmt), sol = \
-                                json.loads(line)
-                            try:
-                                lemma_statements_todo.remove((module_prefix,
-                                                              done_lemma_stmt))
-                            except ValueError:
-                                eprint(f"filename: {filename}, "
-                                       f"module_prefix: {module_prefix}, "
-                                       f"done_lemma_stmt: {done_lemma_stmt}")
-                                raise
-                            solutions.append(((filename, module_prefix,
-                                               done_lemma_stmt),
-                                              recover_sol(sol)))
-                        pass
-                except FileNotFoundError:
-                    pass
+            if args.cost_ordering:
+                lemma_costs = estimate_lemma_costs(args, filename, cmds,
+                                                   all_lemma_statements)
+
+            # Other machines sharing a job queue append to the same
+            # timings files, so only start them over when we're alone.
+            if not args.resume and not args.job_queue and \
+               timings_file(args, filename).exists():
+                timings_file(args, filename).unlink()
+            if args.resume and proofs_file.exists():
+                eprint(f"Resuming from {str(proofs_file)}", guard=args.verbose >= 1)
+                resumed_solutions = proofs_file_solutions(proofs_file)
+                lemmas_in_this_file = set(all_lemma_statements)
+                done_lemmas = set()
+                for (done_filename, module_prefix, done_lemma_stmt), _ \
+                        in resumed_solutions:
+                    if (module_prefix, done_lemma_stmt) \
+                       not in lemmas_in_this_file:
+                        eprint(f"filename: {done_filename}, "
+                               f"module_prefix: {module_prefix}, "
+                               f"done_lemma_stmt: {done_lemma_stmt}")
+                        raise ValueError(f"{done_lemma_stmt} is not a lemma "
+                                         f"in {filename}")
+                    done_lemmas.add((module_prefix, done_lemma_stmt))
+                lemma_statements_todo = [
+                    lemma for lemma in lemma_statements_todo
+                    if lemma not in done_lemmas]
+                solutions.extend(resumed_solutions)
             if args.proofs_file:
                 with open(args.proofs_file, 'r') as f:
                     proof_names = [line.strip() for line in f]
@@ -610,78 +1575,213 @@ def search_file_multithreaded(args: argparse.Namespace,
                     if serapi_instance.lemma_name_from_statement(
                         stmt) == args.proof]
 
-            for module_prefix, lemma_statement in lemma_statements_todo:
-                all_jobs.append((str(filename), module_prefix,
-                                 lemma_statement))
-        for job in all_jobs:
-            jobs.put(job)
-        workers = [multiprocessing.Process(target=search_file_worker,
-                                           args=(args, predictor,
-                                                 predictor_lock,
-                                                 jobs, done, widx))
-                   for widx in range(min(args.num_threads,
-                                         len(all_jobs)))]
-        for worker in workers:
-            worker.start()
+            file_jobs.append(
+                (sum(lemma_costs[lemma] for lemma in lemma_statements_todo)
+                 if args.cost_ordering else 0,
+                 [(str(filename), module_prefix, lemma_statement)
+                  for module_prefix, lemma_statement
+                  in lemma_statements_todo]))
+        # Start on the most expensive files first, so that the run
+        # doesn't end waiting on one worker with a slow file. Jobs
+        # within a file stay in order, since workers move through a
+        # file from top to bottom.
+        if args.cost_ordering:
+            file_jobs.sort(key=lambda cost_and_jobs: -cost_and_jobs[0])
+        all_jobs = [job for _, jobs_in_file in file_jobs
+                    for job in jobs_in_file]
+        if args.job_queue:
+            job_queue: Optional[FileJobQueue] = \
+                FileJobQueue(args.job_queue, args.lease_time)
+            unwrap(job_queue).add_jobs(all_jobs)
+            num_jobs = unwrap(job_queue).num_unfinished()
+        else:
+            job_queue = None
+            num_jobs = len(all_jobs)
+
+        report_writer = ReportWriter(args, predictor) \
+            if args.generate_report else None
+        filenames_by_str = dict(zip(map(str, args.filenames),
+                                    args.filenames))
+        solutions_by_file = dict(zip(map(str, args.filenames),
+                                     file_solutions))
+        jobs_left_in_file = {str(filename): 0
+                             for filename in args.filenames}
+        for done_file, _, _ in all_jobs:
+            jobs_left_in_file[done_file] += 1
+        # Files that were already done can be written right away. When
+        # the jobs are shared with other machines we can't tell when a
+        # file is done, so those are all written at the end.
+        if report_writer and not job_queue:
+            for filename, solutions in zip(args.filenames, file_solutions):
+                if jobs_left_in_file[str(filename)] == 0:
+                    report_writer.add_file(filename, solutions)
+
+        def append_solution(job: Tuple[str, str, str],
+                            sol: SearchResult) -> None:
+            done_file, done_module, done_lemma = job
+            proofs_file = (args.output_dir /
+                           (util.safe_abbrev(Path2(done_file),
+                                             args.filenames)
+                            + "-proofs.txt"))
+            # One write per line, so that lines from other machines
+            # appending to the same file don't get interleaved.
+            with proofs_file.open('a') as f:
+                f.write(json.dumps(((done_file, done_module, done_lemma),
+                                    sol.to_dict())) + "\n")
+
+        def record_solution(job: Tuple[str, str, str],
+                            sol: SearchResult,
+                            appended: bool = False) -> None:
+            done_file, done_module, done_lemma = job
+            if not appended:
+                append_solution(job, sol)
+            solutions_by_file[done_file].append(
+                ((done_file, done_module, done_lemma), sol))
+            bar.update()
+            if report_writer and not job_queue:
+                jobs_left_in_file[done_file] -= 1
+                if jobs_left_in_file[done_file] == 0:
+                    report_writer.add_file(
+                        filenames_by_str[done_file],
+                        solutions_by_file[done_file])
+                report_writer.refresh_index()
+
         num_already_done = sum([len(solutions)
                                 for solutions in file_solutions])
-        with tqdm(total=len(all_jobs) + num_already_done,
+        with tqdm(total=num_jobs + num_already_done,
                   dynamic_ncols=True) as bar:
             bar.update(n=num_already_done)
             bar.refresh()
-            for _ in range(len(all_jobs)):
-                (done_file, done_module, done_lemma), sol = done.get()
-                proofs_file = (args.output_dir /
-                               (util.safe_abbrev(Path2(done_file),
-                                                 args.filenames)
-                                + "-proofs.txt"))
-                with proofs_file.open('a') as f:
-                    f.write(json.dumps(((done_file, done_module, done_lemma),
-                                        sol.to_dict())))
-                    f.write("\n")
-                dict(zip(map(str, args.filenames),
-                         file_solutions))[done_file].append(
-                    ((done_file, done_module, done_lemma), sol))
-                bar.update()
-
-        for worker in workers:
-            worker.join()
-
-        if args.generate_report:
-            model_name = dict(predictor.getOptions())["predictor"]
-            stats: List[search_report.ReportStats] = []
-            for filename, solutions in tqdm(zip(args.filenames, file_solutions),
-                                            desc="Generating output",
-                                            total=len(args.filenames)):
-                blocks = blocks_from_scrape_and_sols(
-                    args.prelude / filename,
-                    [(lemma_stmt, module_name, sol)
-                     for (filename, module_name, lemma_stmt), sol
-                     in solutions])
-                write_solution_vfile(args, filename, model_name, blocks)
-                write_html(args, args.output_dir, filename, blocks)
-                write_csv(args, filename, blocks)
-                stats.append(stats_from_blocks(blocks, str(filename)))
-
-            produce_index(args, predictor, stats)
+            if args.time_budget is None:
+                for job, sol in run_search_workers(args, predictor,
+                                                   predictor_lock,
+                                                   all_jobs, job_queue):
+                    if not job_queue:
+                        record_solution(job, sol)
+                        continue
+                    # The result goes in the proofs file before the job
+                    # is marked done, so that whoever sees the queue
+                    # empty also sees every result in the proofs files.
+                    append_solution(job, sol)
+                    if not job_queue.complete(job):
+                        eprint(f"{job[2]} was already finished by "
+                               f"another worker, dropping this result",
+                               guard=args.verbose >= 1)
+                        continue
+                    record_solution(job, sol, appended=True)
+            else:
+                run_anytime_rounds(args, predictor, predictor_lock,
+                                   all_jobs, record_solution)
+
+        if report_writer and job_queue:
+            if job_queue.num_unfinished() > 0:
+                eprint("Other machines are still searching, leaving the "
+                       "report to whichever finishes last",
+                       guard=args.verbose >= 1)
+                report_writer.close()
+                return
+            if not job_queue.claim_report():
+                eprint("Another machine is writing the report",
+                       guard=args.verbose >= 1)
+                report_writer.close()
+                return
+            # Other machines wrote some of the results, so go back to
+            # the proofs files for all of them.
+            for filename in args.filenames:
+                report_writer.add_file(filename, proofs_file_solutions(
+                    args.output_dir /
+                    (util.safe_abbrev(filename, args.filenames)
+                     + "-proofs.txt")))
+
+        if report_writer:
+            report_writer.finish()
     pass
 
 
+def write_file_outputs(args: argparse.Namespace, filename: Path2,
+                       model_name: str,
+                       solutions: List[Tuple[Tuple[str, str, str],
+                                             Solution]]) \
+        -> 'search_report.ReportStats':
+    blocks = blocks_from_scrape_and_sols(
+        args.prelude / filename,
+        [(lemma_stmt, module_name, sol)
+         for (_, module_name, lemma_stmt), sol
+         in solutions])
+    write_solution_vfile(args, filename, model_name, blocks)
+    write_html(args, args.output_dir, filename, blocks)
+    write_csv(args, filename, blocks)
+    return stats_from_blocks(blocks, str(filename))
+
+
+class ReportWriter:
+    # Writes the report for each file on a pool of background
+    # processes as soon as all of its lemmas are done, and rewrites the
+    # index whenever more files are finished, so that long runs have a
+    # usable partial report along the way.
+    def __init__(self, args: argparse.Namespace,
+                 predictor: TacticPredictor) -> None:
+        self.args = args
+        self.predictor = predictor
+        self.model_name = dict(predictor.getOptions())["predictor"]
+        self.pool = multiprocessing.Pool(args.report_processes)
+        self.in_progress: Dict[str, Any] = {}
+        self.file_stats: Dict[str, 'search_report.ReportStats'] = {}
+
+    def add_file(self, filename: Path2,
+                 solutions: List[Tuple[Tuple[str, str, str],
+                                       Solution]]) -> None:
+        self.in_progress[str(filename)] = self.pool.apply_async(
+            write_file_outputs,
+            (self.args, filename, self.model_name, list(solutions)))
+
+    def refresh_index(self) -> None:
+        finished = [filename for filename, result
+                    in self.in_progress.items() if result.ready()]
+        if not finished:
+            return
+        for filename in finished:
+            self.file_stats[filename] = self.in_progress.pop(filename).get()
+        self.write_index()
+
+    def write_index(self) -> None:
+        produce_index(self.args, self.predictor,
+                      [self.file_stats[str(filename)]
+                       for filename in self.args.filenames
+                       if str(filename) in self.file_stats])
+
+    def finish(self) -> None:
+        for filename, result in tqdm(list(self.in_progress.items()),
+                                     desc="Generating output"):
+            self.file_stats[filename] = result.get()
+        self.in_progress = {}
+        self.close()
+        self.write_index()
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+
 def blocks_from_scrape_and_sols(
         src_filename: Path2,
-        lemma_statements_done: List[Tuple[str, str, SearchResult]]
+        lemma_statements_done: List[Tuple[str, str, Solution]]
         ) -> List[DocumentBlock]:
 
     interactions = data.read_all_text_data(
         src_filename.with_suffix(".v.scrape"))
 
-    def lookup(module: str, lemma_stmt: str) -> Optional[SearchResult]:
-        for lstmt, lmod, lresult in lemma_statements_done:
-            if (lmod == module and
-                    serapi_instance.kill_comments(lstmt).strip()
-                    == serapi_instance.kill_comments(lemma_stmt).strip()):
-                return lresult
-        return None
+    def normalize_stmt(lemma_stmt: str) -> str:
+        return serapi_instance.kill_comments(lemma_stmt).strip()
+
+    # Where a lemma was solved more than once, the first solution wins
+    solutions_by_lemma: Dict[Tuple[str, str], Solution] = {}
+    for lstmt, lmod, lresult in lemma_statements_done:
+        solutions_by_lemma.setdefault((lmod, normalize_stmt(lstmt)),
+                                      lresult)
+
+    def lookup(module: str, lemma_stmt: str) -> Optional[Solution]:
+        return solutions_by_lemma.get((module, normalize_stmt(lemma_stmt)))
 
     def generate():
         cur_lemma_stmt = ""
@@ -774,7 +1874,7 @@ def write_solution_vfile(args: argparse.Namespace, filename: Path2,
         pass
 
 
-def html_header(tag: Tag, doc: Doc, text: Text, css: List[str],
+def html_header(tag: Tag, doc: 'Doc', text: Text, css: List[str],
                 javascript: List[str], title: str) -> None:
     with tag('head'):
         for filename in css:
@@ -806,6 +1906,7 @@ def write_csv(args: argparse.Namespace, filename: str,
 def write_html(args: argparse.Namespace,
                output_dir: str, filename: Path2,
                doc_blocks: List[DocumentBlock]) -> None:
+    from yattag import Doc
     global unnamed_goal_number
     unnamed_goal_number = 0
     doc, tag, text, line = Doc().ttl()
@@ -861,7 +1962,7 @@ def write_lemma_button(lemma_statement: str, module: Optional[str],
                 text(lemma_statement.strip())
 
 
-def write_commands(commands: List[str], tag: Tag, text: Text, doc: Doc):
+def write_commands(commands: List[str], tag: Tag, text: Text, doc: 'Doc'):
     for cmd in commands:
         with tag('code', klass='plaincommand'):
             text(cmd.strip("\n"))
@@ -881,7 +1982,7 @@ def subgoal_to_string(args: argparse.Namespace, sg: Obligation) -> str:
 def write_tactics(args: argparse.Namespace,
                   tactics: List[TacticInteraction],
                   region_idx: int,
-                  tag: Tag, text: Text, doc: Doc):
+                  tag: Tag, text: Text, doc: 'Doc'):
     for t_idx, t in enumerate(tactics):
         idStr = '{}-{}'.format(region_idx, t_idx)
         subgoals_str = "(" + ",".join([subgoal_to_string(args, subgoal)
@@ -945,7 +2046,8 @@ def attempt_search(args: argparse.Namespace,
                    coq: serapi_instance.SerapiInstance,
                    bar_idx: int,
                    predictor: TacticPredictor,
-                   predictor_lock: threading.Lock) \
+                   predictor_lock: threading.Lock,
+                   worker_state: 'WorkerState') \
         -> SearchResult:
     if args.add_env_lemmas:
         with args.add_env_lemmas.open('r') as f:
@@ -954,23 +2056,49 @@ def attempt_search(args: argparse.Namespace,
                           for lemma_name in f]
     else:
         env_lemmas = []
-    timer = threading.Timer(args.max_search_time_per_lemma, _thread.interrupt_main)
+    worker_state.timings.start_lemma()
+    lemma_time = args.max_search_time_per_lemma
+    if worker_state.deadline is not None:
+        lemma_time = max(0, min(lemma_time,
+                                worker_state.deadline - time.time()))
+    timer = threading.Timer(lemma_time, _thread.interrupt_main)
     timer.start()
+    if args.search_type == 'best-first':
+        search_fn = best_first_proof_search_with_graph
+    else:
+        search_fn = dfs_proof_search_with_graph
     try:
-        result = dfs_proof_search_with_graph(lemma_statement, module_name,
-                                            env_lemmas,
-                                            coq,
-                                            args, bar_idx, predictor,
-                                            predictor_lock)
+        result = search_fn(lemma_statement, module_name,
+                           env_lemmas,
+                           coq,
+                           args, bar_idx, predictor,
+                           predictor_lock, worker_state)
     except:
         raise KilledException("Lemma timeout")
     finally:
         timer.cancel()
+    if worker_state.failure_memo:
+        eprint(f"Failure memo has saved "
+               f"{worker_state.failure_memo.coq_calls_saved} "
+               f"coq calls so far", guard=args.verbose >= 2)
+    if worker_state.subgoal_memo:
+        eprint(f"Replayed {worker_state.subgoal_memo.replays} memoized "
+               f"subgoals so far", guard=args.verbose >= 2)
+    if worker_state.hammer:
+        eprint(f"Hammer has closed {len(worker_state.hammer.proved)} of "
+               f"{len(worker_state.hammer.tried)} obligations in this file "
+               f"so far", guard=args.verbose >= 2)
     return result
 
 
-@dataclass(init=True)
+ContextKey = Tuple[Tuple[Tuple[str, Tuple[str, ...]], ...], ...]
+
+
 class LabeledNode:
+    # There's one of these for every prediction the search makes, so
+    # they're kept small. Nodes made from the same context share it.
+    __slots__ = ["prediction", "certainty", "time_taken", "node_id",
+                 "context_before", "previous"]
     prediction: str
     certainty: float
     time_taken: Optional[float]
@@ -978,15 +2106,64 @@ class LabeledNode:
     context_before: ProofContext
     previous: Optional["LabeledNode"]
 
+    def __init__(self, prediction: str, certainty: float,
+                 time_taken: Optional[float], node_id: int,
+                 context_before: ProofContext,
+                 previous: Optional["LabeledNode"]) -> None:
+        self.prediction = prediction
+        self.certainty = certainty
+        self.time_taken = time_taken
+        self.node_id = node_id
+        self.context_before = context_before
+        self.previous = previous
+
+
+def exact_context_key(context: ProofContext) -> ContextKey:
+    # Unlike context_key, this keeps the context exactly as coq printed
+    # it, so that the context can be given back as it was.
+    return tuple(tuple((obl.goal, tuple(obl.hypotheses)) for obl in goals)
+                 for goals in context)
+
+
+class ContextStore:
+    # Interns the proof contexts of a search, so that nodes reaching the
+    # same context share one copy of it. The store keeps every context
+    # until the lemma is done, so it's only worth it where the nodes
+    # live that long anyway, as in best-first search; DFS drops the
+    # nodes of a branch when it backtracks out of it.
+    def __init__(self) -> None:
+        self.contexts: Dict[ContextKey, ProofContext] = {}
+        self.last_context: Optional[ProofContext] = None
+        self.last_interned: Optional[ProofContext] = None
+
+    def intern(self, context: ProofContext) -> ProofContext:
+        # The search usually makes several nodes in a row from the same
+        # context object, so check for that before hashing it.
+        if context is self.last_context:
+            return unwrap(self.last_interned)
+        interned = self.contexts.setdefault(exact_context_key(context),
+                                            context)
+        self.last_context = context
+        self.last_interned = interned
+        return interned
+
 
 class SearchGraph:
-    __graph: pgv.AGraph
-    __next_node_id: int
+    # The graph is kept as flat lists indexed by node id, and only
+    # turned into a graphviz graph when it's drawn, which can happen in
+    # another process (see render_graphs).
+    __labels: List[Tuple[str, float]]
+    __parents: List[int]
+    __colors: Dict[int, str]
+    contexts: Optional[ContextStore]
     start_node: LabeledNode
 
-    def __init__(self, lemma_name: str) -> None:
-        self.__graph = pgv.AGraph(directed=True)
-        self.__next_node_id = 0
+    def __init__(self, lemma_name: str,
+                 intern_contexts: bool = False) -> None:
+        self.__labels = []
+        self.__parents = []
+        self.__colors = {}
+        self.contexts = ContextStore() if intern_contexts else None
         self.start_node = self.mkNode(Prediction(lemma_name, 1.0),
                                       ProofContext([], [], [], []),
                                       None)
@@ -998,26 +2175,22 @@ class SearchGraph:
         return [self.mkNode(pred, context_before, src) for pred in predictions]
 
     def mkNode(self, prediction: Prediction, context_before: ProofContext,
-               previous_node: Optional[LabeledNode],
-               **kwargs) -> LabeledNode:
-        self.__graph.add_node(self.__next_node_id,
-                              label="{}\n({:.2f})".format(
-                                  prediction.prediction,
-                                  prediction.certainty),
-                              **kwargs)
-        self.__next_node_id += 1
+               previous_node: Optional[LabeledNode]) -> LabeledNode:
         newNode = LabeledNode(prediction.prediction, prediction.certainty,
-                              None, self.__next_node_id-1,
-                              context_before, previous_node)
-        if previous_node:
-            self.__graph.add_edge(previous_node.node_id,
-                                  newNode.node_id, **kwargs)
+                              None, len(self.__labels),
+                              self.contexts.intern(context_before)
+                              if self.contexts else context_before,
+                              previous_node)
+        self.__labels.append((prediction.prediction, prediction.certainty))
+        self.__parents.append(previous_node.node_id
+                              if previous_node else -1)
         return newNode
 
     def mkQED(self, predictionNode: LabeledNode):
-        self.mkNode(Prediction("QED", 1.0), ProofContext([], [], [], []),
-                    predictionNode,
-                    fillcolor="green", style="filled")
+        qedNode = self.mkNode(Prediction("QED", 1.0),
+                              ProofContext([], [], [], []),
+                              predictionNode)
+        self.setNodeColor(qedNode, "green")
         cur_node = predictionNode
         cur_path = []
         while cur_node != self.start_node:
@@ -1030,13 +2203,54 @@ class SearchGraph:
         pass
 
     def setNodeColor(self, node: LabeledNode, color: str) -> None:
-        node_handle = self.__graph.get_node(node.node_id)
-        node_handle.attr["fillcolor"] = color
-        node_handle.attr["style"] = "filled"
+        self.__colors[node.node_id] = color
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"labels": self.__labels,
+                "parents": self.__parents,
+                "colors": {str(node_id): color for node_id, color
+                           in self.__colors.items()}}
 
     def draw(self, filename: str) -> None:
-        with nostderr():
-            self.__graph.draw(filename, prog="dot")
+        draw_graph(self.to_dict(), filename)
+
+
+# A serialized graph and the file to draw it to, or None once there
+# are no more graphs.
+GraphJob = Optional[Tuple[Dict[str, Any], str]]
+
+
+def draw_graph(graph: Dict[str, Any], filename: str) -> None:
+    # Draws a graph from SearchGraph.to_dict(). pygraphviz is only
+    # needed here, so processes that never draw don't load it.
+    import pygraphviz as pgv
+    agraph = pgv.AGraph(directed=True)
+    colors = graph["colors"]
+    for node_id, ((prediction, certainty), parent) in \
+            enumerate(zip(graph["labels"], graph["parents"])):
+        attrs: Dict[str, str] = {}
+        if str(node_id) in colors:
+            attrs = {"fillcolor": colors[str(node_id)], "style": "filled"}
+        agraph.add_node(node_id, label="{}\n({:.2f})".format(prediction,
+                                                             certainty),
+                        **attrs)
+        if parent >= 0:
+            agraph.add_edge(parent, node_id)
+    with nostderr():
+        agraph.draw(filename, prog="dot")
+
+
+def render_graphs(graphs: 'multiprocessing.Queue[GraphJob]') -> None:
+    # Draws the graphs the search workers send, until it gets None.
+    while True:
+        item = graphs.get()
+        if item is None:
+            break
+        graph, filename = item
+        try:
+            draw_graph(graph, filename)
+        except Exception as e:
+            eprint(f"Couldn't draw {filename}: {e}")
 
 
 class SubSearchResult (NamedTuple):
@@ -1044,10 +2258,131 @@ class SubSearchResult (NamedTuple):
     solved_subgoals: int
 
 
-def contextInPath(full_context: ProofContext, path: List[LabeledNode]):
-    return any([serapi_instance.contextSurjective(full_context,
-                                                  n.context_before)
-                for n in path])
+def normalize_term(term: str) -> str:
+    return " ".join(term.split())
+
+
+def obligation_key(obligation: Obligation) -> Tuple[str, Tuple[str, ...]]:
+    return (normalize_term(obligation.goal),
+            tuple(sorted(normalize_term(hyp)
+                         for hyp in obligation.hypotheses)))
+
+
+def context_key(context: ProofContext) -> ContextKey:
+    return tuple(tuple(obligation_key(obligation) for obligation in goals)
+                 for goals in [context.fg_goals, context.bg_goals,
+                               context.shelved_goals,
+                               context.given_up_goals])
+
+
+class TranspositionEntry(NamedTuple):
+    remaining_depth: int
+    hit_depth_limit: bool
+
+
+class TranspositionTable:
+    # Proof states (together with the subgoal distances that determine
+    # how much extra depth closing them buys) that were already fully
+    # searched from a given remaining depth. Searching the same state
+    # again with no more depth left is assumed not to do any better.
+    # That's only approximately true, since the predictions see the
+    # tactics before them, so the table is opt-in, and subtrees that
+    # were cut short because of the path to them aren't recorded.
+    __entries: Dict[Tuple[ContextKey, Tuple[int, ...]], TranspositionEntry]
+
+    def __init__(self) -> None:
+        self.__entries = {}
+        self.hits = 0
+
+    def lookup(self, context: ProofContext,
+               subgoal_distance_stack: List[int],
+               remaining_depth: int) -> Optional[TranspositionEntry]:
+        entry = self.__entries.get((context_key(context),
+                                    tuple(subgoal_distance_stack)))
+        if entry and entry.remaining_depth >= remaining_depth:
+            self.hits += 1
+            return entry
+        return None
+
+    def record(self, context: ProofContext,
+               subgoal_distance_stack: List[int],
+               remaining_depth: int, hit_depth_limit: bool) -> None:
+        key = (context_key(context), tuple(subgoal_distance_stack))
+        entry = self.__entries.get(key)
+        if entry is None or entry.remaining_depth < remaining_depth:
+            self.__entries[key] = TranspositionEntry(remaining_depth,
+                                                     hit_depth_limit)
+
+    def forget(self, context: ProofContext,
+               subgoal_distance_stack: List[int]) -> None:
+        self.__entries.pop((context_key(context),
+                            tuple(subgoal_distance_stack)), None)
+
+
+class LogProbBeam:
+    # The best total log certainty of any path that coq got through to
+    # each depth, for pruning paths that fall too far behind it.
+    def __init__(self, width: Optional[float]) -> None:
+        self.width = width
+        self.best: Dict[int, float] = {}
+
+    def prunes(self, depth: int, log_certainty: float) -> bool:
+        if self.width is None or depth not in self.best:
+            return False
+        return log_certainty < self.best[depth] - self.width
+
+    def record(self, depth: int, log_certainty: float) -> None:
+        if log_certainty > self.best.get(depth, -math.inf):
+            self.best[depth] = log_certainty
+
+
+def log_of_certainty(certainty: float) -> float:
+    return math.log(max(certainty, sys.float_info.min))
+
+
+def certain_predictions(args: argparse.Namespace,
+                        predictions: List[Prediction]) -> List[Prediction]:
+    return [prediction for prediction in predictions
+            if prediction.certainty >= args.min_certainty]
+
+
+class PathContextIndex:
+    # The contexts on the current search path, bucketed by the first
+    # goal of each. A context can only be surjective onto an ancestor
+    # if it contains that ancestor's first goal, so checking a new
+    # context only runs the full surjectivity check against the
+    # ancestors in the buckets of its own goals.
+    __buckets: Dict[Optional[str], List[ProofContext]]
+    __keys: List[Optional[str]]
+
+    def __init__(self, contexts: List[ProofContext] = []) -> None:
+        self.__buckets = {}
+        self.__keys = []
+        for context in contexts:
+            self.push(context)
+
+    def push(self, context: ProofContext) -> None:
+        key = context.all_goals[0].goal if context.all_goals else None
+        self.__buckets.setdefault(key, []).append(context)
+        self.__keys.append(key)
+
+    def pop(self) -> None:
+        key = self.__keys.pop()
+        bucket = self.__buckets[key]
+        bucket.pop()
+        if not bucket:
+            del self.__buckets[key]
+
+    def contains(self, full_context: ProofContext) -> bool:
+        if full_context.all_goals:
+            keys: List[Optional[str]] = \
+                list({obligation.goal
+                      for obligation in full_context.all_goals})
+        else:
+            keys = [None]
+        return any(serapi_instance.contextSurjective(full_context, context)
+                   for key in keys
+                   for context in self.__buckets.get(key, []))
 
 
 def numNodesInTree(branching_factor: int, depth: int):
@@ -1065,19 +2400,338 @@ def time_on_path(node: LabeledNode) -> float:
         return time_on_path(unwrap(node.previous)) + unwrap(node.time_taken)
 
 
+def time_per_tactic(args: argparse.Namespace,
+                    coq: serapi_instance.SerapiInstance,
+                    tactic: Optional[str] = None) -> float:
+    # With --use-hammer every tactic has hammer run after it; with
+    # --async-hammer only hammer itself needs the extra time.
+    if args.use_hammer or (args.async_hammer and tactic == HAMMER_TACTIC):
+        return coq.hammer_timeout + args.max_tactic_time
+    return args.max_tactic_time
+
+
+def tactic_timeout(args: argparse.Namespace,
+                   coq: serapi_instance.SerapiInstance,
+                   previousNode: LabeledNode,
+                   tactic: Optional[str] = None) -> float:
+    time_left = max(args.max_proof_time - time_on_path(previousNode), 0)
+    return min(time_left, time_per_tactic(args, coq, tactic))
+
+
+class TacticFailureMemo:
+    # Tactics already known to fail on an identical goal and
+    # hypotheses, so that we don't have to ask coq again. Environments
+    # are (file, hash of the commands run before the lemma) pairs.
+    # Errors only hold in the same environment; that goes for parse
+    # errors too, since a Tactic Notation or Ltac defined between two
+    # lemmas can make a tactic parse. Timeouts only hold for timeouts no
+    # longer than the one that was hit.
+    __errors: Dict[Tuple[ContextKey, str], Tuple[Exception, Any]]
+    __timeouts: Dict[Tuple[ContextKey, str, Any], float]
+
+    def __init__(self) -> None:
+        self.__errors = {}
+        self.__timeouts = {}
+        self.coq_calls_saved = 0
+
+    def lookup(self, context: ContextKey, tactic: str, env_id: Any,
+               timeout: float) -> Optional[Exception]:
+        error_entry = self.__errors.get((context, tactic))
+        if error_entry:
+            error, error_env_id = error_entry
+            if error_env_id == env_id:
+                self.coq_calls_saved += 1
+                return error
+        timed_out_after = self.__timeouts.get((context, tactic, env_id))
+        if timed_out_after is not None and timeout <= timed_out_after:
+            self.coq_calls_saved += 1
+            return serapi_instance.TimeoutError(
+                f"Timed out after {timed_out_after}s before")
+        return None
+
+    def record(self, context: ContextKey, tactic: str, env_id: Any,
+               error: Exception, timeout: float) -> None:
+        if isinstance(error, serapi_instance.TimeoutError):
+            key = (context, tactic, env_id)
+            self.__timeouts[key] = max(timeout,
+                                       self.__timeouts.get(key, 0.0))
+        else:
+            self.__errors[(context, tactic)] = (error, env_id)
+
+
+class TacticTimeouts:
+    # How long tactics with each stem took when they succeeded, so
+    # that a candidate can be given about as long as its stem has
+    # needed before instead of the full --max-tactic-time. Optionally
+    # the times are also kept by the size of the goal (in powers of
+    # two characters), falling back to the stem's times when there
+    # aren't enough for that size yet.
+    #
+    # A tactic that ran out of an adapted timeout is kept as a sample at
+    # that timeout, since all it says is that the tactic needed at least
+    # that long; counting only successes would let every timeout pull
+    # the percentile further down. A stem's timeout also never goes
+    # below the longest it has taken to succeed.
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.percentile = args.timeout_percentile
+        self.min_samples = args.timeout_min_samples
+        self.min_timeout = args.min_tactic_time
+        self.by_goal_size = args.timeouts_by_goal_size
+        self.samples: Dict[Tuple[str, int], List[float]] = {}
+        self.num_successes: Dict[Tuple[str, int], int] = {}
+        self.longest_success: Dict[Tuple[str, int], float] = {}
+
+    def keys(self, tactic: str, goal_size: int) -> List[Tuple[str, int]]:
+        stem = serapi_instance.get_stem(tactic)
+        if self.by_goal_size:
+            return [(stem, goal_size.bit_length()), (stem, -1)]
+        return [(stem, -1)]
+
+    def record(self, tactic: str, goal_size: int, seconds: float) -> None:
+        for key in self.keys(tactic, goal_size):
+            bisect.insort(self.samples.setdefault(key, []), seconds)
+            self.num_successes[key] = self.num_successes.get(key, 0) + 1
+            self.longest_success[key] = max(
+                self.longest_success.get(key, 0.0), seconds)
+
+    def record_timeout(self, tactic: str, goal_size: int,
+                       timeout: float) -> None:
+        for key in self.keys(tactic, goal_size):
+            bisect.insort(self.samples.setdefault(key, []), timeout)
+
+    def timeout(self, tactic: str, goal_size: int, max_timeout: float) \
+            -> float:
+        for key in self.keys(tactic, goal_size):
+            if self.num_successes.get(key, 0) >= self.min_samples:
+                times = self.samples[key]
+                idx = min(len(times) - 1,
+                          max(0, math.ceil(len(times) * self.percentile
+                                           / 100) - 1))
+                return min(max_timeout,
+                           max(self.min_timeout, times[idx],
+                               self.longest_success[key]))
+        return max_timeout
+
+
+def goal_size(context: ProofContext) -> int:
+    if context.fg_goals:
+        return len(context.fg_goals[0].goal)
+    return 0
+
+
+ObligationKey = Tuple[str, Tuple[str, ...]]
+# A subgoal the search is in the middle of: what it looked like when
+# it was opened, and the tactics run on it since.
+OpenSubgoal = Tuple[ObligationKey, List[str]]
+
+
+class SubgoalMemo:
+    # The tactics that closed each subgoal the search has closed in the
+    # current file, keyed on the subgoal's goal and hypotheses, so that
+    # they can be tried again when the same subgoal comes up instead of
+    # searching for it.
+    def __init__(self) -> None:
+        self.filename: Optional[str] = None
+        self.solutions: Dict[ObligationKey, List[str]] = {}
+        self.replays = 0
+
+    def start_file(self, filename: str) -> None:
+        if filename != self.filename:
+            self.filename = filename
+            self.solutions = {}
+
+    def lookup(self, key: ObligationKey) -> Optional[List[str]]:
+        return self.solutions.get(key)
+
+    def record(self, key: ObligationKey, tactics: List[str]) -> None:
+        if key not in self.solutions or \
+           len(tactics) < len(self.solutions[key]):
+            self.solutions[key] = tactics
+
+    def forget(self, key: ObligationKey) -> None:
+        # For tactics that didn't close the subgoal again, so that the
+        # next ones that do can take their place.
+        self.solutions.pop(key, None)
+
+
+@dataclass
+class WorkerState:
+    # Things a search worker keeps across the lemmas it searches
+    failure_memo: Optional[TacticFailureMemo]
+    timings: PhaseTimings
+    graph_queue: Optional['multiprocessing.Queue[GraphJob]'] = None
+    tactic_timeouts: Optional[TacticTimeouts] = None
+    subgoal_memo: Optional[SubgoalMemo] = None
+    hammer: Optional[AsyncHammer] = None
+    # The file and the commands run in it before the current lemma
+    env_id: Tuple[str, str] = ("", "")
+    # When the whole run has to stop, if it has a time budget
+    deadline: Optional[float] = None
+
+
+class Candidates:
+    # The candidate tactics at one node of the search. Knows which of
+    # them will fail without running them in coq: either from the
+    # failure memo, or, when coq is a pool of instances, by trying each
+    # chunk of upcoming candidates on all of them at once before the
+    # search gets to them, so that the search only waits on failing
+    # candidates once per chunk instead of once per candidate.
+    def __init__(self, args: argparse.Namespace,
+                 coq: serapi_instance.SerapiInstance,
+                 worker_state: WorkerState,
+                 predictions: List[Prediction],
+                 context_before: ProofContext,
+                 previousNode: LabeledNode) -> None:
+        self.args = args
+        self.coq = coq
+        self.failure_memo = worker_state.failure_memo
+        self.tactic_timeouts = worker_state.tactic_timeouts
+        self.context_before = context_before
+        self.previousNode = previousNode
+        self.goal_size = goal_size(context_before)
+        if self.failure_memo:
+            self.context_key = context_key(context_before)
+            self.env_id = worker_state.env_id
+        self.predictions: List[Prediction] = []
+        self.max_timeouts: List[float] = []
+        self.limited_by_path: List[bool] = []
+        self.timeouts: List[float] = []
+        for prediction in predictions:
+            self.add(prediction)
+        self.failures: Dict[int, Tuple[Exception, float]] = {}
+        # How long the candidates that went through in parallel took
+        self.successes: Dict[int, float] = {}
+        self.evaluated: Set[int] = set()
+
+    def add(self, prediction: Prediction) -> int:
+        # Adds a candidate after the others, returning its index
+        max_timeout = tactic_timeout(self.args, self.coq, self.previousNode,
+                                     prediction.prediction)
+        self.predictions.append(prediction)
+        self.max_timeouts.append(max_timeout)
+        self.limited_by_path.append(
+            max_timeout < time_per_tactic(self.args, self.coq,
+                                          prediction.prediction))
+        self.timeouts.append(
+            self.tactic_timeouts.timeout(prediction.prediction,
+                                         self.goal_size, max_timeout)
+            if self.tactic_timeouts else max_timeout)
+        return len(self.predictions) - 1
+
+    def known_failure(self, prediction_idx: int) \
+            -> Optional[Tuple[Exception, float]]:
+        if prediction_idx in self.failures:
+            return self.failures[prediction_idx]
+        if self.failure_memo:
+            error = self.failure_memo.lookup(
+                self.context_key,
+                self.predictions[prediction_idx].prediction,
+                self.env_id, self.timeouts[prediction_idx])
+            if error:
+                return (error, 0.0)
+        if not hasattr(self.coq, "try_in_parallel") or len(self.coq) < 2 \
+           or prediction_idx in self.evaluated:
+            return None
+        chunk_idxs = [idx for idx in range(prediction_idx,
+                                           len(self.predictions))
+                      if idx not in self.evaluated and
+                      (not self.failure_memo or
+                       not self.failure_memo.lookup(
+                           self.context_key,
+                           self.predictions[idx].prediction,
+                           self.env_id, self.timeouts[idx]))][:len(self.coq)]
+        # The instances all get the longest timeout in the chunk; a
+        # failure with more time than a candidate would get still
+        # counts as a failure for it.
+        chunk_timeout = max(self.timeouts[idx] for idx in chunk_idxs)
+        results = self.coq.try_in_parallel(
+            [self.predictions[idx].prediction for idx in chunk_idxs],
+            chunk_timeout)
+        for idx, (error, time_taken) in zip(chunk_idxs, results):
+            if error:
+                self.record_failure(idx, error, time_taken, chunk_timeout)
+            else:
+                self.successes[idx] = time_taken
+                self.record_success(idx, time_taken)
+        self.evaluated.update(chunk_idxs)
+        return self.failures.get(prediction_idx)
+
+    def record_failure(self, prediction_idx: int, error: Exception,
+                       time_taken: float,
+                       timeout: Optional[float] = None) -> None:
+        self.failures[prediction_idx] = (error, time_taken)
+        if timeout is None:
+            timeout = self.timeouts[prediction_idx]
+        if self.failure_memo:
+            self.failure_memo.record(
+                self.context_key,
+                self.predictions[prediction_idx].prediction,
+                self.env_id, error, timeout)
+        if self.tactic_timeouts and \
+           isinstance(error, serapi_instance.TimeoutError) and \
+           timeout < self.max_timeouts[prediction_idx]:
+            self.tactic_timeouts.record_timeout(
+                self.predictions[prediction_idx].prediction,
+                self.goal_size, timeout)
+
+    def cut_short_by_path(self, prediction_idx: int,
+                          error: Exception) -> bool:
+        # Whether the candidate timed out with less time than it would
+        # have had if the path before it had been quicker
+        return isinstance(error, serapi_instance.TimeoutError) and \
+            self.limited_by_path[prediction_idx]
+
+    def record_success(self, prediction_idx: int, time_taken: float) -> None:
+        if self.tactic_timeouts:
+            self.tactic_timeouts.record(
+                self.predictions[prediction_idx].prediction,
+                self.goal_size, time_taken)
+
+
+def tryCandidate(args: argparse.Namespace,
+                 coq: serapi_instance.SerapiInstance,
+                 candidates: Candidates,
+                 prediction_idx: int,
+                 previousNode: LabeledNode) \
+                 -> Tuple[ProofContext, int, int, int,
+                          Optional[Exception], float, bool]:
+    known_failure = candidates.known_failure(prediction_idx)
+    if known_failure:
+        error, time_taken = known_failure
+        # Not read from coq: on a pool, that would take back the
+        # successes try_in_parallel left for the candidates after this.
+        return (candidates.context_before, 0, 0, 0, error, time_taken,
+                False)
+    result = tryPrediction(args, coq,
+                           candidates.predictions[prediction_idx].prediction,
+                           previousNode,
+                           candidates.timeouts[prediction_idx])
+    error = result[4]
+    if error:
+        candidates.record_failure(prediction_idx, error, result[5])
+    elif prediction_idx in candidates.successes:
+        # The pool kept the parallel run instead of running it again,
+        # so that run's time is the tactic's time.
+        result = result[:5] + (candidates.successes[prediction_idx],) \
+            + result[6:]
+    else:
+        candidates.record_success(prediction_idx, result[5])
+    return result
+
+
 def tryPrediction(args: argparse.Namespace,
                   coq: serapi_instance.SerapiInstance,
                   prediction: str,
-                  previousNode: LabeledNode) \
+                  previousNode: LabeledNode,
+                  timeout: Optional[float] = None) \
                   -> Tuple[ProofContext, int, int, int,
                            Optional[Exception], float, bool]:
     coq.quiet = True
-    time_left = max(args.max_proof_time - time_on_path(previousNode), 0)
     start_time = time.time()
-    time_per_command = (coq.hammer_timeout + args.max_tactic_time
-                        if coq.use_hammer else args.max_tactic_time)
+    if timeout is None:
+        timeout = tactic_timeout(args, coq, previousNode, prediction)
     try:
-        coq.run_stmt(prediction, timeout=min(time_left, time_per_command))
+        coq.run_stmt(prediction, timeout=timeout)
         error = None
     except (serapi_instance.TimeoutError, serapi_instance.ParseError,
             serapi_instance.CoqExn, serapi_instance.OverflowError,
@@ -1145,6 +2799,311 @@ class TqdmSpy(tqdm):
         super().update(value)
 
 
+def get_relevant_lemmas(args: argparse.Namespace,
+                        coq: serapi_instance.SerapiInstance) -> List[str]:
+    if args.relevant_lemmas == "local":
+        return coq.local_lemmas[:-1]
+    elif args.relevant_lemmas == "hammer":
+        return coq.get_hammer_premises()
+    elif args.relevant_lemmas == "searchabout":
+        return coq.get_lemmas_about_head()
+    else:
+        assert False, args.relevant_lemmas
+
+
+def update_distance_stack(subgoal_distance_stack: List[int],
+                          extra_depth: int,
+                          subgoals_closed: int,
+                          subgoals_opened: int) -> Tuple[List[int], int]:
+    # ### 1.
+    if subgoal_distance_stack:
+        new_distance_stack = (subgoal_distance_stack[:-1] +
+                              [subgoal_distance_stack[-1]+1])
+    else:
+        new_distance_stack = []
+
+    # ### 2.
+    new_extra_depth = extra_depth
+    for _ in range(subgoals_closed):
+        closed_goal_distance = new_distance_stack.pop()
+        new_extra_depth += closed_goal_distance
+
+    # ### 3.
+    new_distance_stack += [0] * subgoals_opened
+
+    return new_distance_stack, new_extra_depth
+
+
+def update_open_subgoals(open_subgoals: List[OpenSubgoal],
+                         tactic: str,
+                         subgoals_closed: int,
+                         subgoals_opened: int,
+                         context_after: ProofContext,
+                         subgoal_memo: Optional[SubgoalMemo]) \
+                         -> List[OpenSubgoal]:
+    # Like update_distance_stack, but keeps every tactic run in each
+    # open subgoal, including those in the subgoals nested inside it,
+    # and remembers the tactics for each subgoal that gets closed.
+    new_open_subgoals = [(key, tactics + [tactic])
+                         for key, tactics in open_subgoals]
+    for _ in range(subgoals_closed):
+        key, tactics = new_open_subgoals.pop()
+        if subgoal_memo:
+            subgoal_memo.record(key, tactics)
+    for _ in range(subgoals_opened):
+        new_open_subgoals.append(
+            (obligation_key(context_after.fg_goals[0]), []))
+    return new_open_subgoals
+
+
+def memoized_subgoal(subgoal_memo: Optional[SubgoalMemo],
+                     open_subgoals: List[OpenSubgoal]) \
+                     -> Optional[List[str]]:
+    # The tactics that closed the subgoal we're at before, if it was
+    # just opened and we've closed the same one already.
+    if not subgoal_memo or not open_subgoals or open_subgoals[-1][1]:
+        return None
+    return subgoal_memo.lookup(open_subgoals[-1][0])
+
+
+class ReplayStep(NamedTuple):
+    tactic: str
+    context_before: ProofContext
+    context_after: ProofContext
+    num_stmts: int
+    subgoals_closed: int
+    subgoals_opened: int
+    time_taken: float
+    unshelved: bool
+
+
+def replay_subgoal(args: argparse.Namespace,
+                   coq: serapi_instance.SerapiInstance,
+                   tactics: List[str],
+                   previousNode: LabeledNode) -> Optional[List[ReplayStep]]:
+    # Runs the tactics that closed the same subgoal before. If they
+    # close it again, with the last of them, returns what each did;
+    # otherwise takes them back off coq.
+    steps: List[ReplayStep] = []
+    level = 0
+    for tactic_idx, tactic in enumerate(tactics):
+        context_before = unwrap(coq.proof_context)
+        context_after, num_stmts, subgoals_closed, subgoals_opened, \
+            error, time_taken, unshelved = \
+            tryPrediction(args, coq, tactic, previousNode)
+        if error:
+            break
+        steps.append(ReplayStep(tactic, context_before, context_after,
+                                num_stmts, subgoals_closed, subgoals_opened,
+                                time_taken, unshelved))
+        level -= subgoals_closed
+        if level < 0:
+            if tactic_idx == len(tactics) - 1:
+                return steps
+            break
+        level += subgoals_opened
+    for step in steps:
+        for _ in range(step.num_stmts):
+            coq.cancel_last()
+    return None
+
+
+def net_subgoals(steps: List[ReplayStep]) -> Tuple[int, int]:
+    # How many subgoals a run of steps closed and then opened, taken as
+    # a whole, as tryPrediction counts them for a single tactic.
+    level = 0
+    lowest_level = 0
+    for step in steps:
+        level -= step.subgoals_closed
+        lowest_level = min(lowest_level, level)
+        level += step.subgoals_opened
+    return -lowest_level, level - lowest_level
+
+
+def candidate_order(worker_state: WorkerState, context: ProofContext,
+                    candidates: Candidates) -> Iterator[int]:
+    # The order to try the candidates in. If the hammer instance closes
+    # the focused obligation while the search is going through them,
+    # hammer goes next, instead of only helping the next time the
+    # obligation comes up.
+    hammer = worker_state.hammer
+    hammer_idx = next((idx for idx, prediction
+                       in enumerate(candidates.predictions)
+                       if prediction.prediction == HAMMER_TACTIC), None)
+    hammer_tried = False
+    for idx in range(len(candidates.predictions)):
+        if hammer and not hammer_tried and context.fg_goals and \
+           hammer.proves(context.fg_goals[0]):
+            if hammer_idx is None:
+                hammer_idx = candidates.add(Prediction(HAMMER_TACTIC, 1.0))
+            hammer_tried = True
+            yield hammer_idx
+        if idx == hammer_idx:
+            if hammer_tried:
+                continue
+            hammer_tried = True
+        yield idx
+
+
+def hammer_first(worker_state: WorkerState, context: ProofContext,
+                 predictions: List[Prediction]) -> List[Prediction]:
+    # Puts hammer ahead of the predictions if the hammer instance has
+    # closed the focused obligation, or otherwise asks it to try.
+    hammer = worker_state.hammer
+    if not hammer or not context.fg_goals:
+        return predictions
+    if not hammer.proves(context.fg_goals[0]):
+        hammer.submit(context.fg_goals[0])
+        return predictions
+    return [Prediction(HAMMER_TACTIC, 1.0)] + \
+        [prediction for prediction in predictions
+         if prediction.prediction != HAMMER_TACTIC]
+
+
+def prediction_commands(prediction: str, unshelved: bool,
+                        subgoals_closed: int, subgoals_opened: int) \
+                        -> List[str]:
+    # The statements tryPrediction ran, in order, to get to the
+    # resulting context.
+    return ([prediction] +
+            (["Unshelve."] if unshelved else []) +
+            ["}"] * subgoals_closed +
+            ["{"] * subgoals_opened)
+
+
+class CandidateStep(NamedTuple):
+    error: Optional[Exception]
+    # Whether the candidate might have gone through on a quicker path
+    path_dependent: bool
+    # How much the candidate counts towards the search width
+    width_used: int
+    # The prediction's node, and the one the search goes on from (its
+    # Unshelve node, if it unshelved goals). None if the candidate
+    # failed and failures aren't drawn.
+    tactic_node: Optional[LabeledNode]
+    node: Optional[LabeledNode]
+    context_after: ProofContext
+    num_stmts: int
+    subgoals_closed: int
+    subgoals_opened: int
+    unshelved: bool
+    subgoal_distance_stack: List[int]
+    extra_depth: int
+    open_subgoals: List[OpenSubgoal]
+    proved: bool
+    # Why there's no point searching below the node, if there isn't
+    dead_end: Optional[str]
+
+
+def try_candidate_step(args: argparse.Namespace,
+                       coq: serapi_instance.SerapiInstance,
+                       g: SearchGraph,
+                       worker_state: WorkerState,
+                       candidates: Candidates,
+                       prediction_idx: int,
+                       depth: int,
+                       path_log_certainty: float,
+                       beam: LogProbBeam,
+                       path_contexts: PathContextIndex,
+                       subgoal_distance_stack: List[int],
+                       extra_depth: int,
+                       open_subgoals: List[OpenSubgoal],
+                       pbar: tqdm) -> CandidateStep:
+    # Tries one candidate at the node the candidates were predicted
+    # at, and makes its node(s) in the graph. Coq is left after the
+    # candidate if it went through; what to do with that is up to the
+    # search.
+    prediction = candidates.predictions[prediction_idx]
+    previousNode = candidates.previousNode
+    context_after, num_stmts, subgoals_closed, subgoals_opened, \
+        error, time_taken, unshelved = \
+        tryCandidate(args, coq, candidates, prediction_idx, previousNode)
+    if error:
+        predictionNode = None
+        if args.show_failing_predictions:
+            predictionNode = g.mkNode(prediction, candidates.context_before,
+                                      previousNode)
+            predictionNode.time_taken = time_taken
+            if isinstance(error, RecursionError):
+                g.setNodeColor(predictionNode, "grey75")
+            else:
+                g.setNodeColor(predictionNode, "red")
+        return CandidateStep(error,
+                             candidates.cut_short_by_path(prediction_idx,
+                                                          error),
+                             1 if args.count_failing_predictions else 0,
+                             predictionNode, predictionNode, context_after,
+                             0, 0, 0, False, subgoal_distance_stack,
+                             extra_depth, open_subgoals, False, None)
+    pbar.update(1)
+    assert cast(TqdmSpy, pbar).n > 0
+    beam.record(depth,
+                path_log_certainty + log_of_certainty(prediction.certainty))
+
+    tacticNode = g.mkNode(prediction, candidates.context_before,
+                          previousNode)
+    tacticNode.time_taken = time_taken
+    predictionNode = tacticNode
+    if unshelved:
+        predictionNode = g.mkNode(Prediction("Unshelve.", 1.0),
+                                  candidates.context_before, tacticNode)
+        predictionNode.time_taken = 0
+
+    new_distance_stack, new_extra_depth = \
+        update_distance_stack(subgoal_distance_stack, extra_depth,
+                              subgoals_closed, subgoals_opened)
+    new_open_subgoals = update_open_subgoals(
+        open_subgoals, prediction.prediction, subgoals_closed,
+        subgoals_opened, context_after, worker_state.subgoal_memo)
+
+    proved = completed_proof(coq)
+    path_dependent = False
+    width_used = 1
+    dead_end: Optional[str] = None
+    if proved:
+        pass
+    elif worker_state.timings.timed("context checks",
+                                    path_contexts.contains, context_after):
+        if not args.count_softfail_predictions:
+            width_used = 0
+        path_dependent = True
+        dead_end = "resulting context is in current path"
+        g.setNodeColor(predictionNode, "orange")
+    elif worker_state.timings.timed("context checks",
+                                    contextIsBig, context_after):
+        dead_end = "resulting context has too big a goal"
+        g.setNodeColor(predictionNode, "orange4")
+    return CandidateStep(None, path_dependent, width_used,
+                         tacticNode, predictionNode, context_after,
+                         num_stmts, subgoals_closed, subgoals_opened,
+                         unshelved, new_distance_stack, new_extra_depth,
+                         new_open_subgoals, proved, dead_end)
+
+
+def draw_search_graph(args: argparse.Namespace, g: SearchGraph,
+                      module_name: Optional[str], lemma_name: str,
+                      worker_state: WorkerState, solved: bool) -> None:
+    global unnamed_goal_number
+    if args.draw_graphs == "none" or \
+       (args.draw_graphs == "failures" and solved):
+        return
+    if module_name:
+        module_prefix = escape_lemma_name(module_name)
+    else:
+        module_prefix = ""
+    if lemma_name == "":
+        unnamed_goal_number += 1
+        filename = (f"{args.output_dir}/{module_prefix}{lemma_name}"
+                    f"{unnamed_goal_number}.svg")
+    else:
+        filename = f"{args.output_dir}/{module_prefix}{lemma_name}.svg"
+    with worker_state.timings.phase("graph drawing"):
+        if worker_state.graph_queue:
+            worker_state.graph_queue.put((g.to_dict(), filename))
+        else:
+            g.draw(filename)
+
+
 def dfs_proof_search_with_graph(lemma_statement: str,
                                 module_name: Optional[str],
                                 extra_env_lemmas: List[str],
@@ -1152,129 +3111,214 @@ def dfs_proof_search_with_graph(lemma_statement: str,
                                 args: argparse.Namespace,
                                 bar_idx: int,
                                 predictor: TacticPredictor,
-                                predictor_lock: threading.Lock) \
+                                predictor_lock: threading.Lock,
+                                worker_state: WorkerState) \
                                 -> SearchResult:
     global unnamed_goal_number
     unnamed_goal_number = 0
     lemma_name = serapi_instance.lemma_name_from_statement(lemma_statement)
     g = SearchGraph(lemma_name)
 
-    if args.relevant_lemmas == "local":
-        relevant_lemmas = coq.local_lemmas[:-1] + extra_env_lemmas
-    elif args.relevant_lemmas == "hammer":
-        relevant_lemmas = coq.get_hammer_premises() + extra_env_lemmas
-    elif args.relevant_lemmas == "searchabout":
-        relevant_lemmas = coq.get_lemmas_about_head() + extra_env_lemmas
-    else:
-        assert False, args.relevant_lemmas
+    relevant_lemmas = get_relevant_lemmas(args, coq) + extra_env_lemmas
+
+    checkpoints = CoqCheckpoints(coq)
 
-    def cleanupSearch(num_stmts: int, msg: Optional[str] = None):
+    def cleanupSearch(checkpoint: int, msg: Optional[str] = None):
         if msg:
-            eprint(f"Cancelling {num_stmts} statements "
-                   f"because {msg}.", guard=args.verbose >= 2)
-        for _ in range(num_stmts):
-            coq.cancel_last()
+            eprint(f"Cancelling {checkpoints.checkpoint() - checkpoint} "
+                   f"statements because {msg}.", guard=args.verbose >= 2)
+        checkpoints.restore(checkpoint)
     hasUnexploredNode = False
+    # Whether the current subtree was cut short by something that
+    # depends on the path to it (a context already on the path, the
+    # log-probability beam, or a timeout shortened by the time the path
+    # already took), in which case its failure isn't recorded in the
+    # transposition table.
+    pathDependentPrune = False
+    transpositions = TranspositionTable() if args.transposition_table \
+        else None
+    # The context at each search() call on the current path
+    path_contexts = PathContextIndex([unwrap(coq.proof_context)])
+    beam = LogProbBeam(args.log_prob_beam)
+    subgoal_memo = worker_state.subgoal_memo
+
+    def replayMemoizedSubgoal(pbar: tqdm, current_path: List[LabeledNode],
+                              subgoal_distance_stack: List[int],
+                              extra_depth: int,
+                              open_subgoals: List[OpenSubgoal]) \
+            -> Optional[SubSearchResult]:
+        # Tries the tactics that closed this subgoal before, as if they
+        # were one prediction; returns None if they no longer work.
+        nonlocal hasUnexploredNode
+        tactics = memoized_subgoal(subgoal_memo, open_subgoals)
+        if not tactics:
+            return None
+        node_checkpoint = checkpoints.checkpoint()
+        steps = replay_subgoal(args, coq, tactics, current_path[-1])
+        if not steps:
+            unwrap(subgoal_memo).forget(open_subgoals[-1][0])
+            return None
+        unwrap(subgoal_memo).replays += 1
+        predictionNode = current_path[-1]
+        for step in steps:
+            checkpoints.advance(step.num_stmts)
+            predictionNode = g.mkNode(Prediction(step.tactic, 1.0),
+                                      step.context_before, predictionNode)
+            predictionNode.time_taken = step.time_taken
+            if step.unshelved:
+                predictionNode = g.mkNode(Prediction("Unshelve.", 1.0),
+                                          step.context_before,
+                                          predictionNode)
+                predictionNode.time_taken = 0
+            open_subgoals = update_open_subgoals(
+                open_subgoals, step.tactic, step.subgoals_closed,
+                step.subgoals_opened, step.context_after, subgoal_memo)
+        g.setNodeColor(predictionNode, "blue")
+        subgoals_closed, subgoals_opened = net_subgoals(steps)
+        new_distance_stack, new_extra_depth = \
+            update_distance_stack(subgoal_distance_stack, extra_depth,
+                                  subgoals_closed, subgoals_opened)
+        if completed_proof(coq):
+            return SubSearchResult(g.mkQED(predictionNode), subgoals_closed)
+        if len(current_path) < args.search_depth + new_extra_depth \
+           and len(current_path) < args.hard_depth_limit:
+            path_contexts.push(steps[-1].context_after)
+            sub_search_result = search(pbar, current_path + [predictionNode],
+                                       new_distance_stack, new_extra_depth,
+                                       open_subgoals)
+            path_contexts.pop()
+            if sub_search_result.solution or \
+               sub_search_result.solved_subgoals > subgoals_opened:
+                return SubSearchResult(
+                    sub_search_result.solution,
+                    subgoals_closed + sub_search_result.solved_subgoals -
+                    subgoals_opened)
+        else:
+            hasUnexploredNode = True
+        cleanupSearch(node_checkpoint, "we finished subsearch")
+        return SubSearchResult(None, subgoals_closed)
 
     def search(pbar: tqdm, current_path: List[LabeledNode],
                subgoal_distance_stack: List[int],
-               extra_depth: int) -> SubSearchResult:
+               extra_depth: int,
+               open_subgoals: List[OpenSubgoal]) -> SubSearchResult:
         nonlocal hasUnexploredNode
+        nonlocal pathDependentPrune
         nonlocal predictor_lock
         nonlocal relevant_lemmas
-        global unnamed_goal_number
+        memoized_result = replayMemoizedSubgoal(pbar, current_path,
+                                                subgoal_distance_stack,
+                                                extra_depth, open_subgoals)
+        if memoized_result:
+            return memoized_result
         tactic_context_before = TacticContext(relevant_lemmas,
                                               coq.prev_tactics,
                                               coq.hypotheses,
                                               coq.goals)
-        with util.silent():
+        with util.silent(), worker_state.timings.phase("prediction"):
             predictions = predictor.predictKTactics(
                 truncate_tactic_context(tactic_context_before,
                                         args.max_term_length),
                         args.max_attempts)
             assert len(predictions) == args.max_attempts
         proof_context_before = coq.proof_context
-        if coq.use_hammer:
+        if args.use_hammer:
             predictions = [Prediction(prediction.prediction[:-1] + "; try hammer.",
                                       prediction.certainty)
                            for prediction in predictions]
+        predictions = hammer_first(worker_state,
+                                   unwrap(proof_context_before), predictions)
+        certain = certain_predictions(args, predictions)
+        if len(certain) < len(predictions):
+            hasUnexploredNode = True
+            predictions = certain
+        path_log_certainty = sum(log_of_certainty(node.certainty)
+                                 for node in current_path[1:])
+        node_checkpoint = checkpoints.checkpoint()
+        candidates = Candidates(args, coq, worker_state, predictions,
+                                unwrap(proof_context_before),
+                                current_path[-1])
         num_successful_predictions = 0
-        for prediction_idx, prediction in enumerate(predictions):
+        for prediction_idx in candidate_order(worker_state,
+                                              unwrap(proof_context_before),
+                                              candidates):
+            prediction = candidates.predictions[prediction_idx]
             if num_successful_predictions >= args.search_width:
                 break
+            if beam.prunes(len(current_path),
+                           path_log_certainty +
+                           log_of_certainty(prediction.certainty)):
+                hasUnexploredNode = True
+                pathDependentPrune = True
+                continue
             try:
-                context_after, num_stmts, \
-                    subgoals_closed, subgoals_opened, \
-                    error, time_taken, unshelved = \
-                    tryPrediction(args, coq, prediction.prediction,
-                                  current_path[-1])
-                if error:
-                    if args.count_failing_predictions:
-                        num_successful_predictions += 1
-                    if args.show_failing_predictions:
-                        predictionNode = g.mkNode(prediction,
-                                                  unwrap(proof_context_before),
-                                                  current_path[-1])
-                        predictionNode.time_taken = time_taken
-                        if isinstance(error, RecursionError):
-                            g.setNodeColor(predictionNode, "grey75")
-                        else:
-                            g.setNodeColor(predictionNode, "red")
+                step = try_candidate_step(
+                    args, coq, g, worker_state, candidates, prediction_idx,
+                    len(current_path), path_log_certainty, beam,
+                    path_contexts, subgoal_distance_stack, extra_depth,
+                    open_subgoals, pbar)
+                num_successful_predictions += step.width_used
+                pathDependentPrune = pathDependentPrune or \
+                    step.path_dependent
+                if step.error:
                     continue
-                num_successful_predictions += 1
-                pbar.update(1)
-                assert cast(TqdmSpy, pbar).n > 0
-
-                predictionNode = g.mkNode(prediction,
-                                          unwrap(proof_context_before),
-                                          current_path[-1])
-                predictionNode.time_taken = time_taken
-                if unshelved:
-                    predictionNode = g.mkNode(Prediction("Unshelve.", 1.0),
-                                              unwrap(proof_context_before),
-                                              predictionNode)
-                    predictionNode.time_taken = 0
-
-                # ### 1.
-                if subgoal_distance_stack:
-                    new_distance_stack = (subgoal_distance_stack[:-1] +
-                                          [subgoal_distance_stack[-1]+1])
-                else:
-                    new_distance_stack = []
-
-                # ### 2.
-                new_extra_depth = extra_depth
-                for _ in range(subgoals_closed):
-                    closed_goal_distance = new_distance_stack.pop()
-                    new_extra_depth += closed_goal_distance
-
-                # ### 3.
-                new_distance_stack += [0] * subgoals_opened
-
-                #############
-                if completed_proof(coq):
+                checkpoints.advance(step.num_stmts)
+                predictionNode = unwrap(step.node)
+                context_after = step.context_after
+                subgoals_closed = step.subgoals_closed
+                subgoals_opened = step.subgoals_opened
+                new_distance_stack = step.subgoal_distance_stack
+                new_extra_depth = step.extra_depth
+
+                if step.proved:
                     solution = g.mkQED(predictionNode)
                     return SubSearchResult(solution, subgoals_closed)
-                elif contextInPath(context_after,
-                                   current_path[1:] + [predictionNode]):
-                    if not args.count_softfail_predictions:
-                        num_successful_predictions -= 1
-                    g.setNodeColor(predictionNode, "orange")
-                    cleanupSearch(num_stmts,
-                                  "resulting context is in current path")
-                elif contextIsBig(context_after):
-                    g.setNodeColor(predictionNode, "orange4")
-                    cleanupSearch(num_stmts,
-                                  "resulting context has too big a goal")
+                elif step.dead_end:
+                    cleanupSearch(node_checkpoint, step.dead_end)
                 elif len(current_path) < args.search_depth + new_extra_depth \
                         and len(current_path) < args.hard_depth_limit:
-                    if subgoals_closed > 0:
-                        g.setNodeColor(predictionNode, "blue")
-                    sub_search_result = search(pbar,
-                                               current_path + [predictionNode],
-                                               new_distance_stack,
-                                               new_extra_depth)
-                    cleanupSearch(num_stmts, "we finished subsearch")
+                    remaining_depth = min(args.search_depth + new_extra_depth,
+                                          args.hard_depth_limit) \
+                        - len(current_path)
+                    known_failure = worker_state.timings.timed(
+                        "context checks", transpositions.lookup,
+                        context_after, new_distance_stack, remaining_depth) \
+                        if transpositions else None
+                    if known_failure:
+                        hasUnexploredNode = hasUnexploredNode or \
+                            known_failure.hit_depth_limit
+                        g.setNodeColor(predictionNode, "darkorange")
+                        cleanupSearch(node_checkpoint,
+                                      "resulting context was already searched")
+                        sub_search_result = SubSearchResult(None, 0)
+                    else:
+                        if subgoals_closed > 0:
+                            g.setNodeColor(predictionNode, "blue")
+                        outer_unexplored = hasUnexploredNode
+                        outer_path_dependent = pathDependentPrune
+                        hasUnexploredNode = False
+                        pathDependentPrune = False
+                        path_contexts.push(context_after)
+                        sub_search_result = search(pbar,
+                                                   current_path +
+                                                   [predictionNode],
+                                                   new_distance_stack,
+                                                   new_extra_depth,
+                                                   step.open_subgoals)
+                        path_contexts.pop()
+                        if not sub_search_result.solution:
+                            cleanupSearch(node_checkpoint,
+                                          "we finished subsearch")
+                        if transpositions and not pathDependentPrune and \
+                           sub_search_result == SubSearchResult(None, 0):
+                            transpositions.record(context_after,
+                                                  new_distance_stack,
+                                                  remaining_depth,
+                                                  hasUnexploredNode)
+                        hasUnexploredNode = hasUnexploredNode or \
+                            outer_unexplored
+                        pathDependentPrune = pathDependentPrune or \
+                            outer_path_dependent
                     if sub_search_result.solution or \
                        sub_search_result.solved_subgoals > subgoals_opened:
                         new_subgoals_closed = \
@@ -1287,7 +3331,7 @@ def dfs_proof_search_with_graph(lemma_statement: str,
                         return SubSearchResult(None, subgoals_closed)
                 else:
                     hasUnexploredNode = True
-                    cleanupSearch(num_stmts, "we hit the depth limit")
+                    cleanupSearch(node_checkpoint, "we hit the depth limit")
                     if subgoals_closed > 0:
                         # depth = (args.search_depth + new_extra_depth + 1) \
                         #     - len(current_path)
@@ -1297,17 +3341,8 @@ def dfs_proof_search_with_graph(lemma_statement: str,
                                           unwrap(proof_context_before),
                                           current_path[-1])
                 g.setNodeColor(predictionNode, "grey25")
-                if module_name:
-                    module_prefix = escape_lemma_name(module_name)
-                else:
-                    module_prefix = ""
-                if lemma_name == "":
-                    unnamed_goal_number += 1
-                    g.draw(f"{args.output_dir}/{module_prefix}"
-                           f"{unnamed_goal_number}.svg")
-                else:
-                    g.draw(f"{args.output_dir}/{module_prefix}"
-                           f"{lemma_name}.svg")
+                draw_search_graph(args, g, module_name, lemma_name,
+                                  worker_state, False)
                 raise
         return SubSearchResult(None, 0)
     total_nodes = numNodesInTree(args.search_width,
@@ -1320,18 +3355,455 @@ def dfs_proof_search_with_graph(lemma_statement: str,
                  leave=False,
                  position=bar_idx + 1,
                  dynamic_ncols=True, bar_format=mybarfmt) as pbar:
-        command_list, _ = search(pbar, [g.start_node], [], 0)
+        command_list, _ = search(pbar, [g.start_node], [], 0, [])
         pbar.clear()
-    if module_name:
-        module_prefix = escape_lemma_name(module_name)
-    else:
-        module_prefix = ""
-    if lemma_name == "":
-        unnamed_goal_number += 1
-        g.draw(f"{args.output_dir}/{module_prefix}{lemma_name}"
-               f"{unnamed_goal_number}.svg")
+    draw_search_graph(args, g, module_name, lemma_name,
+                      worker_state, bool(command_list))
+    if command_list:
+        return SearchResult(SearchStatus.SUCCESS, command_list)
+    elif hasUnexploredNode:
+        return SearchResult(SearchStatus.INCOMPLETE, None)
     else:
-        g.draw(f"{args.output_dir}/{module_prefix}{lemma_name}.svg")
+        return SearchResult(SearchStatus.FAILURE, None)
+
+
+class CoqCheckpoints:
+    # Points in the proof that the search can return coq to. A
+    # checkpoint is how many statements the search had run on top of
+    # the lemma statement when it was taken; restoring one cancels
+    # everything run since. All of the search's backtracking goes
+    # through restore(), so that a backend that can jump straight to a
+    # sertop state only has to change this class. For now restoring is
+    # one cancel_last per statement, since coq_serapy doesn't expose
+    # its state ids or a cancel that keeps its tactic history in sync.
+    def __init__(self, coq: serapi_instance.SerapiInstance) -> None:
+        self.coq = coq
+        self.__num_stmts = 0
+
+    def checkpoint(self) -> int:
+        return self.__num_stmts
+
+    def run_stmt(self, stmt: str, timeout: Optional[float] = None) -> None:
+        self.coq.run_stmt(stmt, timeout=timeout)
+        self.__num_stmts += 1
+
+    def advance(self, num_stmts: int) -> None:
+        # For statements that were run on coq directly
+        self.__num_stmts += num_stmts
+
+    def restore(self, checkpoint: int) -> None:
+        assert checkpoint <= self.__num_stmts
+        while self.__num_stmts > checkpoint:
+            self.coq.cancel_last()
+            self.__num_stmts -= 1
+
+
+class BestFirstEntry(NamedTuple):
+    node: LabeledNode
+    tactic_context: TacticContext
+    path_length: int
+    subgoal_distance_stack: List[int]
+    extra_depth: int
+    open_subgoals: List[OpenSubgoal]
+
+
+class PredictionPipeline:
+    # Runs the predictor on a background thread, so that the
+    # predictions for a node can be made while coq is still running
+    # the tactics of its siblings. Every prediction goes through the
+    # one thread, so the predictor is never called concurrently. The
+    # children of a node are prefetched together, as one batch, once
+    # the search is done expanding it.
+    def __init__(self, args: argparse.Namespace,
+                 predictor: TacticPredictor,
+                 timings: PhaseTimings) -> None:
+        self.args = args
+        self.predictor = predictor
+        self.timings = timings
+        self.executor: Optional[ThreadPoolExecutor] = \
+            ThreadPoolExecutor(max_workers=1) \
+            if args.pipelined_predictions else None
+        self.pending: List[BestFirstEntry] = []
+        # For each prefetched node, its batch and its place in it
+        self.prefetched: Dict[int, Tuple['Future[List[List[Prediction]]]',
+                                         int]] = {}
+
+    def predict(self, contexts: List[TacticContext]) \
+            -> List[List[Prediction]]:
+        return self.predictor.predictKTactics_batch(
+            [truncate_tactic_context(context, self.args.max_term_length)
+             for context in contexts],
+            self.args.max_attempts)
+
+    def prefetch(self, entry: BestFirstEntry) -> None:
+        if self.executor:
+            self.pending.append(entry)
+
+    def flush(self) -> None:
+        # Starts predicting for everything prefetched since last time
+        if not self.executor or not self.pending:
+            return
+        future = self.executor.submit(self.predict,
+                                      [entry.tactic_context
+                                       for entry in self.pending])
+        for idx, entry in enumerate(self.pending):
+            self.prefetched[entry.node.node_id] = (future, idx)
+        self.pending = []
+
+    def predict_batch(self, entries: List[BestFirstEntry]) \
+            -> List[List[Prediction]]:
+        if not self.executor:
+            with util.silent(), self.timings.phase("prediction"):
+                return self.predict([entry.tactic_context
+                                     for entry in entries])
+        batch_ids = {entry.node.node_id for entry in entries}
+        needed = {id(self.prefetched[node_id][0]) for node_id in batch_ids
+                  if node_id in self.prefetched}
+        # Predictions for nodes that aren't up yet, and that haven't
+        # started, would only hold up the ones we need now; they're
+        # made again if their node comes up later.
+        self.pending = []
+        for node_id, (future, _) in list(self.prefetched.items()):
+            if node_id not in batch_ids and id(future) not in needed \
+               and future.cancel():
+                del self.prefetched[node_id]
+        prefetched = [self.prefetched.pop(entry.node.node_id, None)
+                      for entry in entries]
+        missing = [entry.tactic_context for entry, batch
+                   in zip(entries, prefetched) if batch is None]
+        with self.timings.phase("prediction"):
+            missing_predictions = iter(
+                self.executor.submit(self.predict, missing).result()
+                if missing else [])
+            return [batch[0].result()[batch[1]] if batch
+                    else next(missing_predictions)
+                    for batch in prefetched]
+
+    def close(self) -> None:
+        if self.executor:
+            for future, _ in self.prefetched.values():
+                future.cancel()
+            # Wait for a prediction that's already running, so that it
+            # doesn't overlap with the next lemma's.
+            self.executor.shutdown(wait=True)
+
+
+def path_to_node(node: LabeledNode) -> List[LabeledNode]:
+    path = []
+    cur_node: Optional[LabeledNode] = node
+    while cur_node is not None and cur_node.previous is not None:
+        path.append(cur_node)
+        cur_node = cur_node.previous
+    return list(reversed(path))
+
+
+def best_first_proof_search_with_graph(lemma_statement: str,
+                                       module_name: Optional[str],
+                                       extra_env_lemmas: List[str],
+                                       coq: serapi_instance.SerapiInstance,
+                                       args: argparse.Namespace,
+                                       bar_idx: int,
+                                       predictor: TacticPredictor,
+                                       predictor_lock: threading.Lock,
+                                       worker_state: WorkerState) \
+                                       -> SearchResult:
+    global unnamed_goal_number
+    unnamed_goal_number = 0
+    lemma_name = serapi_instance.lemma_name_from_statement(lemma_statement)
+    g = SearchGraph(lemma_name, intern_contexts=True)
+
+    relevant_lemmas = get_relevant_lemmas(args, coq) + extra_env_lemmas
+
+    # The statements run to get from a node's parent to the node
+    # itself, so that we can move coq between any two nodes of the
+    # graph by going through their common ancestor, and the
+    # checkpoint at each node on the way.
+    checkpoints = CoqCheckpoints(coq)
+    node_commands: Dict[int, List[str]] = {g.start_node.node_id: []}
+    node_checkpoints: Dict[int, int] = \
+        {g.start_node.node_id: checkpoints.checkpoint()}
+    cur_node = g.start_node
+
+    def goToNode(target: LabeledNode) -> bool:
+        nonlocal cur_node
+        cur_path = path_to_node(cur_node)
+        target_path = path_to_node(target)
+        common = 0
+        while common < min(len(cur_path), len(target_path)) and \
+                cur_path[common] is target_path[common]:
+            common += 1
+        cur_node = target_path[common - 1] if common > 0 else g.start_node
+        checkpoints.restore(node_checkpoints[cur_node.node_id])
+        for node in target_path[common:]:
+            try:
+                for command in node_commands[node.node_id]:
+                    checkpoints.run_stmt(command, timeout=time_per_tactic(
+                        args, coq, command))
+            except (serapi_instance.TimeoutError, serapi_instance.CoqExn):
+                eprint(f"Failed to replay {node.prediction}, dropping it",
+                       guard=args.verbose >= 2)
+                checkpoints.restore(node_checkpoints[cur_node.node_id])
+                return False
+            cur_node = node
+        return True
+
+    hasUnexploredNode = False
+    frontier: List[Tuple[float, int, BestFirstEntry]] = []
+    # States that are already on the frontier (or were expanded from
+    # it) with at least as much depth left.
+    transpositions = TranspositionTable() if args.transposition_table \
+        else None
+
+    def remaining_depth(path_length: int, extra_depth: int) -> int:
+        return min(args.search_depth + extra_depth,
+                   args.hard_depth_limit) - path_length
+
+    pipeline = PredictionPipeline(args, predictor, worker_state.timings)
+    beam = LogProbBeam(args.log_prob_beam)
+    subgoal_memo = worker_state.subgoal_memo
+
+    def pushEntry(entry: BestFirstEntry, log_certainty: float) -> None:
+        if worker_state.hammer:
+            # So that hammer has the time this entry spends on the
+            # frontier to work on it
+            worker_state.hammer.submit(Obligation(
+                entry.tactic_context.hypotheses,
+                entry.tactic_context.goal))
+        heapq.heappush(frontier,
+                       (-log_certainty, entry.node.node_id, entry))
+
+    def replayMemoizedSubgoal(entry: BestFirstEntry,
+                              log_certainty: float) \
+            -> Optional[LabeledNode]:
+        # Tries the tactics that closed this entry's subgoal before, as
+        # if they were its only prediction. Returns the node they lead
+        # to, or None if they no longer work.
+        nonlocal hasUnexploredNode
+        nonlocal cur_node
+        tactics = memoized_subgoal(subgoal_memo, entry.open_subgoals)
+        if not tactics or not goToNode(entry.node):
+            return None
+        steps = replay_subgoal(args, coq, tactics, entry.node)
+        if not steps:
+            unwrap(subgoal_memo).forget(entry.open_subgoals[-1][0])
+            return None
+        unwrap(subgoal_memo).replays += 1
+        predictionNode = entry.node
+        open_subgoals = entry.open_subgoals
+        for step in steps:
+            predictionNode = g.mkNode(Prediction(step.tactic, 1.0),
+                                      step.context_before, predictionNode)
+            predictionNode.time_taken = step.time_taken
+            if step.unshelved:
+                node_commands[predictionNode.node_id] = []
+                node_checkpoints[predictionNode.node_id] = \
+                    checkpoints.checkpoint()
+                predictionNode = g.mkNode(Prediction("Unshelve.", 1.0),
+                                          step.context_before,
+                                          predictionNode)
+                predictionNode.time_taken = 0
+            checkpoints.advance(step.num_stmts)
+            node_commands[predictionNode.node_id] = \
+                prediction_commands(step.tactic, step.unshelved,
+                                    step.subgoals_closed,
+                                    step.subgoals_opened)
+            node_checkpoints[predictionNode.node_id] = \
+                checkpoints.checkpoint()
+            open_subgoals = update_open_subgoals(
+                open_subgoals, step.tactic, step.subgoals_closed,
+                step.subgoals_opened, step.context_after, subgoal_memo)
+        cur_node = predictionNode
+        g.setNodeColor(predictionNode, "blue")
+        if completed_proof(coq):
+            return predictionNode
+        subgoals_closed, subgoals_opened = net_subgoals(steps)
+        new_distance_stack, new_extra_depth = \
+            update_distance_stack(entry.subgoal_distance_stack,
+                                  entry.extra_depth,
+                                  subgoals_closed, subgoals_opened)
+        if entry.path_length < args.search_depth + new_extra_depth \
+           and entry.path_length < args.hard_depth_limit:
+            new_entry = BestFirstEntry(
+                predictionNode,
+                TacticContext(relevant_lemmas, coq.prev_tactics,
+                              coq.hypotheses, coq.goals),
+                entry.path_length + 1,
+                new_distance_stack,
+                new_extra_depth,
+                open_subgoals)
+            pipeline.prefetch(new_entry)
+            pushEntry(new_entry, log_certainty)
+        else:
+            hasUnexploredNode = True
+        return predictionNode
+
+    def search(pbar: tqdm) -> Optional[List[TacticInteraction]]:
+        nonlocal hasUnexploredNode
+        nonlocal cur_node
+        pushEntry(BestFirstEntry(g.start_node,
+                                 TacticContext(relevant_lemmas,
+                                               coq.prev_tactics,
+                                               coq.hypotheses,
+                                               coq.goals),
+                                 1, [], 0, []), 0.0)
+        while frontier:
+            batch: List[Tuple[float, BestFirstEntry]] = []
+            while frontier and len(batch) < args.search_batch_size:
+                neg_log_certainty, _, entry = heapq.heappop(frontier)
+                replayed_node = replayMemoizedSubgoal(entry,
+                                                      -neg_log_certainty)
+                if replayed_node:
+                    pbar.update(1)
+                    if completed_proof(coq):
+                        return g.mkQED(replayed_node)
+                    continue
+                batch.append((-neg_log_certainty, entry))
+            predictions_batch = pipeline.predict_batch(
+                [entry for _, entry in batch])
+            for (log_certainty, entry), predictions in \
+                    zip(batch, predictions_batch):
+                if not goToNode(entry.node):
+                    continue
+                proof_context_before = coq.proof_context
+                path_contexts = PathContextIndex(
+                    [node.context_before
+                     for node in path_to_node(entry.node)] +
+                    [unwrap(proof_context_before)])
+                if args.use_hammer:
+                    predictions = [Prediction(prediction.prediction[:-1] +
+                                              "; try hammer.",
+                                              prediction.certainty)
+                                   for prediction in predictions]
+                predictions = hammer_first(worker_state,
+                                           unwrap(proof_context_before),
+                                           predictions)
+                certain = certain_predictions(args, predictions)
+                if len(certain) < len(predictions):
+                    hasUnexploredNode = True
+                    predictions = certain
+                candidates = Candidates(args, coq, worker_state,
+                                        predictions,
+                                        unwrap(proof_context_before),
+                                        entry.node)
+                num_successful_predictions = 0
+                path_dependent = False
+                for prediction_idx in candidate_order(
+                        worker_state, unwrap(proof_context_before),
+                        candidates):
+                    prediction = candidates.predictions[prediction_idx]
+                    if num_successful_predictions >= args.search_width:
+                        break
+                    if beam.prunes(entry.path_length,
+                                   log_certainty +
+                                   log_of_certainty(prediction.certainty)):
+                        hasUnexploredNode = True
+                        path_dependent = True
+                        continue
+                    try:
+                        step = try_candidate_step(
+                            args, coq, g, worker_state, candidates,
+                            prediction_idx, entry.path_length,
+                            log_certainty, beam, path_contexts,
+                            entry.subgoal_distance_stack,
+                            entry.extra_depth, entry.open_subgoals, pbar)
+                        num_successful_predictions += step.width_used
+                        path_dependent = path_dependent or \
+                            step.path_dependent
+                        if step.error:
+                            continue
+                        predictionNode = unwrap(step.node)
+                        if step.unshelved:
+                            tacticNode = unwrap(step.tactic_node)
+                            node_commands[tacticNode.node_id] = []
+                            node_checkpoints[tacticNode.node_id] = \
+                                checkpoints.checkpoint()
+                        checkpoints.advance(step.num_stmts)
+                        node_commands[predictionNode.node_id] = \
+                            prediction_commands(prediction.prediction,
+                                                step.unshelved,
+                                                step.subgoals_closed,
+                                                step.subgoals_opened)
+                        node_checkpoints[predictionNode.node_id] = \
+                            checkpoints.checkpoint()
+                        cur_node = predictionNode
+
+                        if step.proved:
+                            return g.mkQED(predictionNode)
+                        elif step.dead_end:
+                            pass
+                        elif transpositions and worker_state.timings.timed(
+                                "context checks", transpositions.lookup,
+                                step.context_after,
+                                step.subgoal_distance_stack,
+                                remaining_depth(entry.path_length,
+                                                step.extra_depth)):
+                            if not args.count_softfail_predictions:
+                                num_successful_predictions -= 1
+                            g.setNodeColor(predictionNode, "darkorange")
+                        elif entry.path_length < \
+                                args.search_depth + step.extra_depth \
+                                and entry.path_length < args.hard_depth_limit:
+                            if transpositions:
+                                transpositions.record(
+                                    step.context_after,
+                                    step.subgoal_distance_stack,
+                                    remaining_depth(entry.path_length,
+                                                    step.extra_depth),
+                                    False)
+                            if step.subgoals_closed > 0:
+                                g.setNodeColor(predictionNode, "blue")
+                            new_entry = BestFirstEntry(
+                                predictionNode,
+                                TacticContext(relevant_lemmas,
+                                              coq.prev_tactics,
+                                              coq.hypotheses,
+                                              coq.goals),
+                                entry.path_length + 1,
+                                step.subgoal_distance_stack,
+                                step.extra_depth,
+                                step.open_subgoals)
+                            pipeline.prefetch(new_entry)
+                            pushEntry(new_entry,
+                                      log_certainty +
+                                      log_of_certainty(prediction.certainty))
+                        else:
+                            hasUnexploredNode = True
+                        goToNode(entry.node)
+                    except serapi_instance.CoqAnomaly:
+                        predictionNode = g.mkNode(prediction,
+                                                  unwrap(proof_context_before),
+                                                  entry.node)
+                        g.setNodeColor(predictionNode, "grey25")
+                        draw_search_graph(args, g, module_name, lemma_name,
+                                          worker_state, False)
+                        raise
+                if transpositions and path_dependent:
+                    # Another way to this state might get further, so
+                    # it shouldn't be cut as a repeat of this one.
+                    transpositions.forget(unwrap(proof_context_before),
+                                          entry.subgoal_distance_stack)
+                pipeline.flush()
+        return None
+
+    total_nodes = numNodesInTree(args.search_width,
+                                 args.search_depth + 2) - 1
+    desc_name = lemma_name
+    if len(desc_name) > 25:
+        desc_name = desc_name[:22] + "..."
+    with TqdmSpy(total=total_nodes, unit="pred", file=sys.stdout,
+                 desc=desc_name, disable=(not args.progress),
+                 leave=False,
+                 position=bar_idx + 1,
+                 dynamic_ncols=True, bar_format=mybarfmt) as pbar:
+        try:
+            command_list = search(pbar)
+        finally:
+            pipeline.close()
+        pbar.clear()
+    if not command_list:
+        goToNode(g.start_node)
+    draw_search_graph(args, g, module_name, lemma_name,
+                      worker_state, bool(command_list))
     if command_list:
         return SearchResult(SearchStatus.SUCCESS, command_list)
     elif hasUnexploredNode:
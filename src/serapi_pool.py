@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# A group of SerapiInstances that are kept in the same state, so that
+# several candidate tactics can be tried at once. The pool stands in
+# for its first ("primary") instance everywhere a SerapiInstance is
+# expected: reads go to the primary, and anything that changes the
+# state of coq is run on every instance in parallel.
+#
+# A tactic that went through in try_in_parallel stays on its instance
+# until the next thing the pool is asked to do. If that is running the
+# same tactic, that instance becomes the primary and the others catch
+# up to it in the background, so the tactic isn't run twice before the
+# search can look at its result.
+
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Tuple, Optional, Any
+
+import coq_serapy as serapi_instance
+from coq_serapy import SerapiInstance
+from util import eprint
+
+
+class SerapiPool:
+    instances: List[SerapiInstance]
+    executors: List[ThreadPoolExecutor]
+    held: List[Optional[str]]
+    pending: List[Tuple[SerapiInstance, Future]]
+
+    def __init__(self, instances: List[SerapiInstance]) -> None:
+        assert len(instances) > 0
+        object.__setattr__(self, "instances", list(instances))
+        # One thread per instance, so that work sent to an instance
+        # always runs in order even if we stopped waiting on it.
+        object.__setattr__(self, "executors",
+                           [ThreadPoolExecutor(max_workers=1)
+                            for _ in instances])
+        object.__setattr__(self, "held", [None for _ in instances])
+        object.__setattr__(self, "pending", [])
+
+    def __enter__(self) -> 'SerapiPool':
+        return self
+
+    def __exit__(self, type, value, traceback) -> None:
+        for executor in self.executors:
+            executor.shutdown(wait=False)
+
+    def __len__(self) -> int:
+        return len(self.instances)
+
+    def __getattr__(self, name: str) -> Any:
+        self._settle()
+        return getattr(self.instances[0], name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        for instance in self.instances:
+            setattr(instance, name, value)
+
+    def _submit_all(self, method: str, *args, **kwargs) -> List[Future]:
+        return [executor.submit(getattr(instance, method), *args, **kwargs)
+                for instance, executor
+                in zip(self.instances, self.executors)]
+
+    def _drop_helper(self, helper_idx: int, reason: str) -> None:
+        eprint(f"Dropping coq helper {helper_idx} from the pool "
+               f"because {reason}")
+        self.instances.pop(helper_idx)
+        self.held.pop(helper_idx)
+        self.executors.pop(helper_idx).shutdown(wait=False)
+
+    def _settle(self, stmt: Optional[str] = None, **kwargs) -> bool:
+        # Takes the tactics left by try_in_parallel back off their
+        # instances, except on one that ran stmt, which becomes the
+        # primary; the rest run stmt in the background to catch up to
+        # it. Returns whether stmt was run that way.
+        if all(tactic is None for tactic in self.held):
+            return False
+        if stmt is not None and stmt in self.held:
+            winner_idx: Optional[int] = self.held.index(stmt)
+        else:
+            winner_idx = None
+        for idx, tactic in enumerate(self.held):
+            if tactic is not None and idx != winner_idx:
+                self.pending.append(
+                    (self.instances[idx],
+                     self.executors[idx].submit(
+                         self.instances[idx].cancel_last)))
+        object.__setattr__(self, "held",
+                           [None for _ in self.instances])
+        if winner_idx is None:
+            self._catch_up()
+            return False
+        self.instances.insert(0, self.instances.pop(winner_idx))
+        self.executors.insert(0, self.executors.pop(winner_idx))
+        for instance, executor in zip(self.instances[1:],
+                                      self.executors[1:]):
+            self.pending.append(
+                (instance, executor.submit(instance.run_stmt,
+                                           stmt, **kwargs)))
+        return True
+
+    def _catch_up(self) -> None:
+        # Waits for the work _settle left running, dropping any helper
+        # that couldn't get back in step with the primary.
+        pending = self.pending
+        object.__setattr__(self, "pending", [])
+        for instance, future in pending:
+            error = future.exception()
+            if error is None or instance not in self.instances:
+                continue
+            instance_idx = self.instances.index(instance)
+            if instance_idx == 0:
+                raise error
+            self._drop_helper(instance_idx,
+                              "it couldn't catch up to the primary")
+
+    def _broadcast(self, method: str, *args, **kwargs) -> Any:
+        self._settle()
+        self._catch_up()
+        futures = self._submit_all(method, *args, **kwargs)
+        primary_error: Optional[BaseException] = futures[0].exception()
+        for helper_idx in reversed(range(1, len(futures))):
+            helper_error = futures[helper_idx].exception()
+            if (helper_error is None) == (primary_error is None):
+                continue
+            if method == "run_stmt" and helper_error is None:
+                # The statement went through on the helper but not
+                # on the primary, so take it back off the helper.
+                self.executors[helper_idx].submit(
+                    self.instances[helper_idx].cancel_last).result()
+            else:
+                self._drop_helper(helper_idx,
+                                  f"it diverged from the primary "
+                                  f"running {method}")
+        return futures[0].result()
+
+    def run_stmt(self, stmt: str, **kwargs) -> None:
+        if not self._settle(stmt, **kwargs):
+            self._broadcast("run_stmt", stmt, **kwargs)
+
+    def cancel_last(self, *args, **kwargs) -> None:
+        self._broadcast("cancel_last", *args, **kwargs)
+
+    def run_into_next_proof(self, *args, **kwargs) -> Any:
+        return self._broadcast("run_into_next_proof", *args, **kwargs)
+
+    def finish_proof(self, *args, **kwargs) -> Any:
+        return self._broadcast("finish_proof", *args, **kwargs)
+
+    def try_in_parallel(self, tactics: List[str], timeout: float) \
+            -> List[Tuple[Optional[Exception], float]]:
+        # Runs each tactic on its own instance, returning what went
+        # wrong (if anything) and how long it took. Tactics that went
+        # through are left on their instances (see _settle).
+        self._settle()
+        self._catch_up()
+        assert len(tactics) <= len(self.instances)
+
+        def attempt(instance: SerapiInstance, tactic: str) \
+                -> Tuple[Optional[Exception], float]:
+            start_time = time.time()
+            try:
+                instance.run_stmt(tactic, timeout=timeout)
+            except (serapi_instance.TimeoutError,
+                    serapi_instance.ParseError,
+                    serapi_instance.CoqExn,
+                    serapi_instance.OverflowError,
+                    RecursionError,
+                    serapi_instance.UnrecognizedError) as e:
+                return e, time.time() - start_time
+            return None, time.time() - start_time
+        futures = [executor.submit(attempt, instance, tactic)
+                   for instance, executor, tactic
+                   in zip(self.instances, self.executors, tactics)]
+        results = [future.result() for future in futures]
+        object.__setattr__(
+            self, "held",
+            [tactic if error is None else None
+             for tactic, (error, _) in zip(tactics, results)] +
+            [None] * (len(self.instances) - len(tactics)))
+        return results
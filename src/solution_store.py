@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+##########################################################################
+#
+#    This file is part of Proverbot9001.
+#
+#    Proverbot9001 is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Proverbot9001 is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Proverbot9001.  If not, see <https://www.gnu.org/licenses/>.
+#
+#    Copyright 2019 Alex Sanchez-Stern and Yousef Alhessi
+#
+##########################################################################
+
+# The proofs that searches have found, kept so that a later run with
+# the same model and search settings can check an old proof instead of
+# searching for it again. Proofs are keyed on the lemma statement,
+# everything before it in its file, the model, and the search
+# parameters. Like the on-disk prediction cache, it's a directory of
+# JSON files that any number of workers, runs, and machines can share.
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import List, Optional, Dict, Any
+
+from coq_serapy import kill_comments
+
+
+def normalize_command(command: str) -> str:
+    return " ".join(kill_comments(command).split())
+
+
+class PrefixHashes:
+    # Hashes of each prefix of the last file's commands, chained so
+    # that every lemma in a file costs one hash more.
+    def __init__(self) -> None:
+        self.commands: Optional[List[str]] = None
+        self.hashes: List[str] = []
+
+    def prefix_hash(self, commands: List[str], length: int) -> str:
+        if commands is not self.commands:
+            self.commands = commands
+            self.hashes = [hashlib.sha256().hexdigest()]
+        while len(self.hashes) <= length:
+            command = commands[len(self.hashes) - 1]
+            self.hashes.append(hashlib.sha256(
+                (self.hashes[-1] + normalize_command(command))
+                .encode('utf-8')).hexdigest())
+        return self.hashes[length]
+
+
+class SolutionStore:
+    directory: str
+    config_hash: str
+
+    def __init__(self, directory: str, model_id: str,
+                 search_params: Dict[str, Any]) -> None:
+        self.directory = directory
+        self.config_hash = hashlib.sha256(json.dumps(
+            [model_id, search_params], sort_keys=True).encode('utf-8')) \
+            .hexdigest()
+        self.prefixes = PrefixHashes()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, commands: List[str], lemma_idx: int) -> str:
+        # The key for the lemma whose statement is commands[lemma_idx]
+        return hashlib.sha256(json.dumps(
+            [self.config_hash,
+             self.prefixes.prefix_hash(commands, lemma_idx),
+             normalize_command(commands[lemma_idx])]).encode('utf-8')) \
+            .hexdigest()
+
+    def disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def lookup(self, key: str) -> Optional[List[str]]:
+        try:
+            with open(self.disk_path(key), 'r') as f:
+                tactics = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tactics
+
+    def store(self, key: str, tactics: List[str]) -> None:
+        path = self.disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tactics, f)
+        os.replace(tmp_path, path)
@@ -173,8 +173,8 @@ def escape_lemma_name(lemma_name : str) -> str:
 import hashlib
 BLOCKSIZE = 65536
 
-def hash_file(filename : str) -> str:
-    hasher = hashlib.md5()
+def hash_file(filename : str, algorithm : str = "md5") -> str:
+    hasher = hashlib.new(algorithm)
     with open(filename, 'rb') as f:
         buf = f.read(BLOCKSIZE)
         while len(buf) > 0: